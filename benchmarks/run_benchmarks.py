@@ -0,0 +1,271 @@
+#!/usr/bin/python
+
+# This file is part of release-path
+#
+#Copyright (c) 2014 Amplify Education
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#THE SOFTWARE.
+
+"""
+Times the release-path operations against synthetic repositories.
+
+The repositories are generated once per run; every timed call gets a fresh
+copy of the remotes and a fresh clone, made outside the timing. Results
+are written as JSON, and a previous result file can be given to compare
+against.
+"""
+
+import os
+import imp
+import sys
+import time
+import shutil
+import logging
+import platform
+import tempfile
+import subprocess
+from argparse import ArgumentParser
+from ConfigParser import SafeConfigParser
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from git import Repo
+import release_trace
+from release_path import create_release_branch, merge_branches, deep_merge, \
+    verify_submodule_branch_structure, close_object_queries
+from release_branch_manager import check_guard_commits
+from synthetic import generate
+
+PendingRelease = imp.load_source(
+    'branches_pending_release',
+    os.path.join(ROOT, 'branches_pending_release')).PendingRelease
+
+# Keep the run self-contained: a fixed identity for merge commits, and
+# file:// submodule clones allowed without touching the user's config
+GIT_ENVIRONMENT = {
+    'GIT_AUTHOR_NAME': 'Benchmark',
+    'GIT_AUTHOR_EMAIL': 'benchmark@example.com',
+    'GIT_COMMITTER_NAME': 'Benchmark',
+    'GIT_COMMITTER_EMAIL': 'benchmark@example.com',
+    'GIT_CONFIG_COUNT': '1',
+    'GIT_CONFIG_KEY_0': 'protocol.file.allow',
+    'GIT_CONFIG_VALUE_0': 'always',
+}
+
+
+def bench_create_release_branch(repo, plan):
+    create_release_branch(repo, '9.0')
+
+
+def bench_merge_branches(repo, plan):
+    merge_branches(repo, plan.releases + ['next'])
+
+
+def bench_deep_merge(repo, plan):
+    deep_merge(repo, plan.releases[0], plan.releases[1])
+
+
+def bench_verify_submodule_branch_structure(repo, plan):
+    for branch in plan.releases + ['next']:
+        verify_submodule_branch_structure(repo, branch, fetch=False)
+
+
+def bench_check_guard_commits(repo, plan):
+    # Includes a detached checkout of each branch, since the check is of HEAD
+    config = SafeConfigParser()
+    config.add_section('guard commits')
+    for branchtype, guard in plan.guards.items():
+        config.set('guard commits', branchtype, guard)
+    for product in plan.products:
+        if product.endswith('/production'):
+            repo.git.checkout('-q', '--detach', 'origin/%s' % product)
+            check_guard_commits(repo, config, 'production')
+
+
+def bench_pending_release(repo, plan):
+    PendingRelease(repo, plan.releases + ['next'])
+
+
+def bench_pending_release_owners(repo, plan):
+    PendingRelease(repo, plan.releases + ['next'], show_owners=True)
+
+
+BENCHMARKS = [
+    ('create_release_branch', bench_create_release_branch),
+    ('merge_branches', bench_merge_branches),
+    ('deep_merge', bench_deep_merge),
+    ('verify_submodule_branch_structure',
+     bench_verify_submodule_branch_structure),
+    ('check_guard_commits', bench_check_guard_commits),
+    ('pending_release', bench_pending_release),
+    ('pending_release_owners', bench_pending_release_owners),
+]
+
+
+def clone(remotes, directory):
+    """
+    Copy the generated remotes into `directory` and clone them there
+    """
+    copied = os.path.join(directory, 'remotes')
+    shutil.copytree(remotes, copied)
+    work = os.path.join(directory, 'work')
+    subprocess.check_call(['git', 'clone', '-q', '--recurse-submodules',
+                           os.path.join(copied, 'super.git'), work])
+    return Repo(work)
+
+
+def run_benchmark(name, func, plan, remotes, scratch, repeat):
+    times = []
+    commands = None
+    for attempt in range(repeat):
+        directory = tempfile.mkdtemp(prefix='%s-' % name, dir=scratch)
+        try:
+            repo = clone(remotes, directory)
+            count = len(release_trace.TRACER.commands)
+            start = time.time()
+            func(repo, plan)
+            times.append(time.time() - start)
+            commands = len(release_trace.TRACER.commands) - count
+        finally:
+            # The clone is about to go, so stop the processes reading it
+            close_object_queries()
+            shutil.rmtree(directory, ignore_errors=True)
+
+    ordered = sorted(times)
+    return {
+        'times': times,
+        'min': ordered[0],
+        'median': ordered[len(ordered) // 2],
+        'mean': sum(times) / len(times),
+        'git_commands': commands,
+    }
+
+
+def compare(results, baseline):
+    lines = ['%-36s %10s %10s %8s' % ('benchmark', 'baseline', 'median',
+                                      'ratio')]
+    for name, _ in BENCHMARKS:
+        if name not in results['results']:
+            continue
+        median = results['results'][name]['median']
+        if name in baseline['results']:
+            before = baseline['results'][name]['median']
+            lines.append('%-36s %10.3f %10.3f %8.2f' %
+                         (name, before, median, median / before))
+        else:
+            lines.append('%-36s %10s %10.3f %8s' % (name, '-', median, '-'))
+    return '\n'.join(lines)
+
+
+def argparser():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--releases', type=int, default=5,
+                        help="Number of release_* branches")
+    parser.add_argument('--submodules', type=int, default=3)
+    parser.add_argument('--products', type=int, default=10,
+                        help="Number of products, each with a product/<name>/<type> "
+                        "branch per branch type")
+    parser.add_argument('--features', type=int, default=50,
+                        help="Number of feature branches")
+    parser.add_argument('--depth', type=int, default=100,
+                        help="Number of commits of shared history")
+    parser.add_argument('--commits', type=int, default=3,
+                        help="Number of commits on each branch")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', nargs='+', metavar='BENCHMARK',
+                        choices=[name for name, _ in BENCHMARKS],
+                        help="Run only these benchmarks")
+    parser.add_argument('--output', default='benchmark-results.json',
+                        help="Where to write the results (defaults to "
+                        "'benchmark-results.json')")
+    parser.add_argument('--compare', metavar='FILE',
+                        help="Earlier results to compare against")
+    parser.add_argument('--keep', action='store_true',
+                        help="Keep the generated repositories")
+    return parser
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    args = argparser().parse_args()
+    os.environ.update(GIT_ENVIRONMENT)
+    release_trace.TRACER.enable()
+
+    scratch = tempfile.mkdtemp(prefix='release-path-benchmark-')
+    remotes = os.path.join(scratch, 'remotes')
+    try:
+        start = time.time()
+        plan = generate(remotes, args.releases, args.submodules,
+                        args.products, args.features, args.depth,
+                        args.commits)
+        sys.stderr.write('Generated %s branches in %s repositories in %.1fs\n'
+                         % (len(plan.branches()), args.submodules + 1,
+                            time.time() - start))
+
+        results = {
+            'parameters': {
+                'releases': args.releases,
+                'submodules': args.submodules,
+                'products': args.products,
+                'features': args.features,
+                'depth': args.depth,
+                'commits': args.commits,
+                'repeat': args.repeat,
+            },
+            'revision': subprocess.Popen(
+                ['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                stdout=subprocess.PIPE).communicate()[0].strip(),
+            'git': subprocess.Popen(
+                ['git', 'version'],
+                stdout=subprocess.PIPE).communicate()[0].strip(),
+            'python': platform.python_version(),
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'results': {},
+        }
+        for name, func in BENCHMARKS:
+            if args.only and name not in args.only:
+                continue
+            result = run_benchmark(name, func, plan, remotes, scratch,
+                                   args.repeat)
+            results['results'][name] = result
+            sys.stderr.write('%-36s median %8.3fs  min %8.3fs  %5s git commands\n'
+                             % (name, result['median'], result['min'],
+                                result['git_commands']))
+    finally:
+        if args.keep:
+            sys.stderr.write('Repositories kept in %s\n' % scratch)
+        else:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    out = open(args.output, 'w')
+    json.dump(results, out, indent=1, sort_keys=True)
+    out.close()
+
+    if args.compare:
+        print compare(results, json.load(open(args.compare)))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
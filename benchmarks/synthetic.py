@@ -0,0 +1,202 @@
+# This file is part of release-path
+#
+#Copyright (c) 2014 Amplify Education
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#THE SOFTWARE.
+
+"""
+Generates local bare repositories shaped like a release path: a
+supermodule and its submodules, all with the same branches, where every
+supermodule commit points each submodule at the matching submodule
+commit.
+
+Every repository is written with a single `git fast-import`, following
+the same plan, so commit N of the supermodule lines up with commit N of
+each submodule.
+"""
+
+import os
+import subprocess
+
+BRANCH_TYPES = ['production', 'preprod', 'current', 'future']
+EPOCH = 1400000000
+
+
+class Plan(object):
+    """
+    The branches and commits to generate, in order. `steps` is a list of
+    (branch, from_branch, commit) triples: a from_branch of None continues
+    the branch itself, and a false `commit` just creates the branch at
+    from_branch without committing
+    """
+    def __init__(self, releases=5, products=10, features=50, depth=100,
+                 commits=3):
+        self.releases = ['release_1.%d' % index for index in range(releases)]
+        self.deploys = ['deploy/%s' % branchtype for branchtype in BRANCH_TYPES]
+        self.products = ['product/p%d/%s' % (index, branchtype)
+                         for index in range(products)
+                         for branchtype in BRANCH_TYPES]
+        self.features = ['feature/f%d' % index for index in range(features)]
+        self.steps = []
+        self.first_commit = {}
+
+        self._extend('master', None, depth)
+        parent = 'master'
+        for release in self.releases:
+            self._extend(release, parent, commits)
+            parent = release
+        self._extend('next', parent, commits)
+
+        # Fixes to every release but the newest, so each has something to
+        # merge downstream
+        for release in self.releases[:-1]:
+            self._extend(release, None, 1)
+
+        for deploy in self.deploys:
+            self._extend(deploy, self.releases[0], commits)
+        for product in self.products:
+            self._extend(product, 'deploy/%s' % product.split('/')[-1],
+                         commits)
+
+        # Every third feature has no commits of its own, so it's already
+        # contained in the release it came from
+        for index, feature in enumerate(self.features):
+            release = self.releases[index % len(self.releases)]
+            count = commits
+            if index % 3 == 0:
+                count = 0
+            self._extend(feature, release, count, create=True)
+
+    def _extend(self, branch, from_branch, count, create=False):
+        if count == 0 and create:
+            self.steps.append((branch, from_branch, False))
+            return
+        for index in range(count):
+            if branch not in self.first_commit:
+                self.first_commit[branch] = len(self.steps)
+            if index == 0:
+                self.steps.append((branch, from_branch, True))
+            else:
+                self.steps.append((branch, None, True))
+
+    def branches(self):
+        return ['master', 'next'] + self.releases + self.deploys + \
+            self.products + self.features
+
+
+def _data(text):
+    return 'data %d\n%s' % (len(text), text)
+
+
+def fast_import(git_dir, plan, name, gitlinks=None, gitmodules=None):
+    """
+    Write `plan` into the bare repository at `git_dir`. `gitlinks` is a
+    list of (path, {mark: sha}) pairs pointing each commit at the
+    submodule commit with the same mark. Returns the {mark: sha} of the
+    repository's own commits
+    """
+    marks_file = os.path.join(git_dir, 'synthetic-marks')
+    process = subprocess.Popen(
+        ['git', 'fast-import', '--quiet', '--export-marks=%s' % marks_file],
+        cwd=git_dir, stdin=subprocess.PIPE)
+
+    tips = {}
+    mark = 0
+    for index, (branch, from_branch, commit) in enumerate(plan.steps):
+        if not commit:
+            process.stdin.write('reset refs/heads/%s\nfrom :%d\n\n' %
+                                (branch, tips[from_branch]))
+            tips[branch] = tips[from_branch]
+            continue
+
+        mark += 1
+        lines = ['commit refs/heads/%s' % branch,
+                 'mark :%d' % mark,
+                 'committer Synthetic <synthetic@example.com> %d +0000' %
+                 (EPOCH + index),
+                 _data('%s: commit %d on %s' % (name, index, branch))]
+        if from_branch is not None:
+            lines.append('from :%d' % tips[from_branch])
+        elif branch in tips:
+            lines.append('from :%d' % tips[branch])
+        if index == 0 and gitmodules:
+            lines.append('M 100644 inline .gitmodules')
+            lines.append(_data(gitmodules))
+        lines.append('M 100644 inline %s/%d' % (branch, index))
+        lines.append(_data('%s %s %d' % (name, branch, index)))
+        for path, shas in gitlinks or []:
+            lines.append('M 160000 %s %s' % (shas[mark], path))
+        process.stdin.write('\n'.join(lines) + '\n\n')
+        tips[branch] = mark
+
+    process.stdin.close()
+    if process.wait() != 0:
+        raise Exception('git fast-import failed in %s' % git_dir)
+
+    shas = {}
+    for line in open(marks_file):
+        mark, sha = line.split()
+        shas[int(mark[1:])] = sha
+    os.remove(marks_file)
+    return shas
+
+
+def generate(directory, releases=5, submodules=3, products=10, features=50,
+             depth=100, commits=3):
+    """
+    Create bare repositories super.git and sub<N>.git under `directory`.
+    Submodule URLs are relative, so the whole directory can be copied.
+    Returns the Plan that was generated
+    """
+    plan = Plan(releases, products, features, depth, commits)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    gitlinks = []
+    gitmodules = []
+    for index in range(submodules):
+        name = 'sub%d' % index
+        git_dir = os.path.join(directory, name + '.git')
+        subprocess.check_call(['git', 'init', '-q', '--bare', git_dir])
+        gitlinks.append((name, fast_import(git_dir, plan, name)))
+        gitmodules.append('[submodule "%s"]\n\tpath = %s\n\turl = ../%s.git\n'
+                          % (name, name, name))
+
+    git_dir = os.path.join(directory, 'super.git')
+    subprocess.check_call(['git', 'init', '-q', '--bare', git_dir])
+    shas = fast_import(git_dir, plan, 'super', gitlinks, ''.join(gitmodules))
+    for name in ['super'] + [path for path, _ in gitlinks]:
+        subprocess.check_call(['git', 'symbolic-ref', 'HEAD',
+                               'refs/heads/master'],
+                              cwd=os.path.join(directory, name + '.git'))
+
+    # The first supermodule commit of each deploy branch guards merges back
+    # into the branch types before it
+    plan.guards = {}
+    for deploy in plan.deploys[1:]:
+        plan.guards[deploy.split('/')[-1]] = shas[
+            _mark_of(plan, plan.first_commit[deploy])]
+    return plan
+
+
+def _mark_of(plan, step):
+    """
+    The fast-import mark of the commit made at `step` of `plan`
+    """
+    return len([commit for _, _, commit in plan.steps[:step + 1] if commit])
@@ -29,7 +29,10 @@ from argparse import ArgumentParser
 from ConfigParser import SafeConfigParser
 
 from git import Repo, GitCommandError
-from release_path import deep_merge
+from release_trace import add_trace_argument, start as start_trace
+from release_path import deep_merge, RefSnapshot, FetchCoordinator, \
+    Reachability, InvalidSubmoduleBranch, release_refspecs, verify_branches, \
+    is_partial_clone, require_lean_support, object_queries
 
 PRODUCT_NAMESPACE="product"
 DEPLOY_NAMESPACE="deploy"
@@ -86,6 +89,11 @@ def find_product_emails(config, failed_branches, fallback_email):
     matcher = re.compile("%s/([-\w]+)/%s" % (PRODUCT_NAMESPACE, BRANCH_TYPE.ANY_TYPE))
     for failed in failed_branches:
         match = re.match(matcher,failed[0])
+        if match is None:
+            # deploy and release branches have no product to notify
+            emails.add(fallback_email)
+            logging.debug("%s is not a product branch: falling back to %s" % (failed[0], fallback_email))
+            continue
         product_name = match.group(1)
         if config.has_option("project email",product_name):
             product_email = config.get("project email", product_name)
@@ -96,7 +104,14 @@ def find_product_emails(config, failed_branches, fallback_email):
             logging.debug("No e-mail found for project %s: falling back to %s" % (product_name, fallback_email))
     return emails
 
-def save_failure_info(failed_branches, config, email_filename, project_filename):
+def save_failure_info(failed_branches, config, email_filename, project_filename,
+                      report_filename=None):
+    """
+    Write the addresses to notify and the failed branches for the failure
+    e-mail, and if report_filename is given, the error of each failed
+    (branch, error) pair, which for a conflicted deep merge lists the
+    conflicted paths, tips and merge bases of every repository involved
+    """
     project_list = ", ".join([ fail[0] for fail in failed_branches])
     logging.info("Failed merges to the following products: %s" % project_list)
     fallback_email = config.get("global","fallback_address")
@@ -113,16 +128,32 @@ def save_failure_info(failed_branches, config, email_filename, project_filename)
     content_file.write(project_list)
     content_file.close()
 
-def init_script():
-    args = parse_args()
+    if report_filename is not None:
+        report_file = open(report_filename, "w")
+        for branch, error in failed_branches:
+            report_file.write("%s\n%s\n\n" % (branch, error))
+        report_file.close()
+
+def init_script(parser=None):
+    if parser is None:
+        parser = argparser()
+    args = parser.parse_args()
     logging.basicConfig(level=args.log_level)
+    start_trace(args.trace)
     logging.debug("Script arguments: %s" % args)
     config = SafeConfigParser()
     if not config.read(args.config_file):
         raise Exception("Configuration file %s was not read" % (args.config_file))
-    return (args, config, Repo())
+    repo = Repo()
+    if is_partial_clone(repo, args.remote):
+        args.lean = True
+    if args.lean:
+        require_lean_support(repo)
+    return (args, config, repo)
 
-def find_branches(args, repo):
+def find_branches(args, repo, refs=None):
+    if refs is None:
+        refs = RefSnapshot(repo)
     source_branch = args.source_branch
     source_type = args.source_branch_type
     dest_branch = args.destination_branch
@@ -132,7 +163,7 @@ def find_branches(args, repo):
     if source_branch is None:
         if source_type is None:
             raise Exception("either --source-type or --source-branch must be specified")
-        source_branch = find_deploy_branch(repo, remote=args.remote, branchtype=source_type)
+        source_branch = find_deploy_branch(repo, remote=args.remote, branchtype=source_type, refs=refs)
 
     if source_type is None:
         source_type = find_branch_type(source_branch)
@@ -141,9 +172,9 @@ def find_branches(args, repo):
     if dest_branch is None:
         if dest_type is None:
             raise Exception("Unable to infer destination branch, and none provided")
-        dest_branch = find_deploy_branch(repo, remote=args.remote, branchtype=dest_type)
+        dest_branch = find_deploy_branch(repo, remote=args.remote, branchtype=dest_type, refs=refs)
     if dest_type:
-        extra_branches = find_product_branches(repo, remote=args.remote, branchtype=dest_type)
+        extra_branches = find_product_branches(repo, remote=args.remote, branchtype=dest_type, refs=refs)
     else:
         extra_branches = None
     branch_tuple = (source_branch, dest_branch, extra_branches)
@@ -157,7 +188,7 @@ def find_branch_type(branch):
     # this is kind of silly-looking, but avoids exposing BRANCH_
     return BRANCH_TYPE.branch_type(branch)
 
-def parse_args():
+def argparser():
     parser = ArgumentParser()
     parser.add_argument("-t", "--source-type", action="store", dest="source_branch_type",
                         help="Type of the branch being merged from: production, preprod, current or future")
@@ -173,21 +204,33 @@ def parse_args():
                         help="Branch being read (will remain unmodified)")
     parser.add_argument("-d", "--dest-branch", action="store", dest="destination_branch",
                         help="Branch to be merged into")
-    return parser.parse_args()
+    parser.add_argument("-j", "--jobs", action="store", dest="jobs", type=int, default=1,
+                        help="Number of branch merges to run at once (defaults to 1)")
+    parser.add_argument("--lean", action="store_true", default=False,
+                        help="Fetch without blobs and merge in memory, for partial clones "
+                        "(the default when the repository already is one)")
+    add_trace_argument(parser)
+    return parser
 
-def find_deploy_branch(repo, remote=DEFAULT_REMOTE, branchtype=BRANCH_TYPE.PRODUCTION):
-    deploy_branch = find_remote_branches(repo, pattern= "deploy/%s" % (branchtype))
+def parse_args():
+    return argparser().parse_args()
+
+def find_deploy_branch(repo, remote=DEFAULT_REMOTE, branchtype=BRANCH_TYPE.PRODUCTION, refs=None):
+    deploy_branch = find_remote_branches(repo, remote=remote, pattern="%s/%s" % (DEPLOY_NAMESPACE, branchtype), refs=refs)
     if 1 != len(deploy_branch):
         raise Exception("Should have found exactly one branch matching %s, but found %s" % (branchtype, len(deploy_branch)))
     return deploy_branch[0]
 
-def find_product_branches(repo, remote=DEFAULT_REMOTE, branchtype=BRANCH_TYPE.PREPROD):
-    product_branches = find_remote_branches(repo, pattern="%s/*/%s" % (PRODUCT_NAMESPACE, branchtype))
+def find_product_branches(repo, remote=DEFAULT_REMOTE, branchtype=BRANCH_TYPE.PREPROD, refs=None):
+    if refs is None:
+        refs = RefSnapshot(repo)
+    product_branches = [branch for branch in refs.namespace(remote, PRODUCT_NAMESPACE, branchtype)
+                        if branch.count("/") == 2]
     if not product_branches:
         raise Exception("No product branches of type '%s' found" % (branchtype))
     return product_branches
 
-def find_upstream_branch(repo, source_branch, remote=DEFAULT_REMOTE):
+def find_upstream_branch(repo, source_branch, remote=DEFAULT_REMOTE, refs=None):
     logging.debug("Seeking upstream branch for %s" % source_branch)
     source_type = find_branch_type(source_branch)
     if source_type is None:
@@ -197,7 +240,7 @@ def find_upstream_branch(repo, source_branch, remote=DEFAULT_REMOTE):
         return None
     dest_branch_candidate = re.sub( source_type + "$", dest_type, source_branch)
     
-    found_branches = find_remote_branches(repo, remote=remote, pattern=dest_branch_candidate)
+    found_branches = find_remote_branches(repo, remote=remote, pattern=dest_branch_candidate, refs=refs)
     logging.debug("Seeking upstream branch matching %s, found %s"
                   % (dest_branch_candidate, found_branches))
     if 1 == len(found_branches):
@@ -210,20 +253,99 @@ def find_upstream_branch(repo, source_branch, remote=DEFAULT_REMOTE):
     else:
         return None
 
-def find_remote_branches(repo, remote=DEFAULT_REMOTE,pattern=None):
-    remote_prefix = "refs/remotes/%s/" % (remote)
-    if pattern is None: # one-line version of this block is not python2.4 compatible
-        search_pattern = remote_prefix
-    else:
-        search_pattern = remote_prefix + pattern
-    command_output = repo.git.for_each_ref(search_pattern, "--format=%(refname)");
-    if command_output:
-        raw_branches = command_output.split("\n")
-        logging.debug("for-each-ref returned %s lines" % (len(raw_branches)))
-        return [ branch.replace(remote_prefix,"") for branch in raw_branches]
-    else:
-        logging.debug("for-each-ref output is empty")
-        return []
+def find_remote_branches(repo, remote=DEFAULT_REMOTE,pattern=None, refs=None):
+    if refs is None:
+        refs = RefSnapshot(repo)
+    branches = refs.match(remote, pattern)
+    logging.debug("Ref snapshot has %s branches matching %s" % (len(branches), pattern))
+    return branches
+
+def upstream_fetcher(repo, remote=DEFAULT_REMOTE, submodules=True, executor=None,
+                     branch_prefix=None, branch_suffix="", lean=False, commits=()):
+    """
+    A FetchCoordinator limited to the product and deploy namespaces, and the
+    release branches too if `branch_prefix` is given
+    """
+    refspecs = release_refspecs(remote, branch_prefix, branch_suffix,
+                                namespaces=(PRODUCT_NAMESPACE, DEPLOY_NAMESPACE))
+    return FetchCoordinator(repo, remote, refspecs, executor, submodules,
+                            lean=lean, commits=commits)
+
+def schedule_upstream_merges(scheduler, repo, remote=DEFAULT_REMOTE, refs=None):
+    """
+    Add every product and deploy merge up the release path to `scheduler`:
+    each product/<name>/<type> and deploy/<type> branch into the branch of
+    the next type, and each deploy/<type> branch into the product branches
+    of the next type once deploy/<type> has been merged upstream
+    """
+    if refs is None:
+        refs = RefSnapshot(repo)
+    for source_type in BRANCH_TYPE._merge_order:
+        dest_type = BRANCH_TYPE.merge_to(source_type)
+        if dest_type is None:
+            continue
+
+        for product_branch in refs.namespace(remote, PRODUCT_NAMESPACE, source_type):
+            if product_branch.count("/") != 2:
+                continue
+            upstream_branch = find_upstream_branch(repo, product_branch, remote, refs)
+            if upstream_branch:
+                scheduler.add(product_branch, upstream_branch)
+
+        source_deploy = find_remote_branches(repo, remote, "%s/%s" % (DEPLOY_NAMESPACE, source_type), refs)
+        dest_deploy = find_remote_branches(repo, remote, "%s/%s" % (DEPLOY_NAMESPACE, dest_type), refs)
+        if len(source_deploy) != 1 or len(dest_deploy) != 1:
+            logging.debug("Skipping deploy merges from %s: found %s and %s"
+                          % (source_type, source_deploy, dest_deploy))
+            continue
+        deploy_merge = scheduler.add(source_deploy[0], dest_deploy[0])
+        for product_branch in refs.namespace(remote, PRODUCT_NAMESPACE, dest_type):
+            if product_branch.count("/") == 2:
+                scheduler.add(source_deploy[0], product_branch, after=[deploy_merge])
+
+def add_schedule_arguments(parser):
+    """
+    Options for scripts that schedule the whole set of upstream and release merges
+    """
+    parser.add_argument("--branch-prefix", default="release_",
+                        help="Prefix of the release branches (defaults to 'release_')")
+    parser.add_argument("--branch-suffix", default="",
+                        help="Suffix of the release branches")
+    parser.add_argument("--no-release-branches", dest="release_branches",
+                        action="store_false", default=True,
+                        help="Only merge the product and deploy branches")
+
+def schedule_fetcher(repo, args, executor=None):
+    """
+    A FetchCoordinator for the branches schedule_all_merges works on
+    """
+    branch_prefix = None
+    if args.release_branches:
+        branch_prefix = args.branch_prefix
+    return upstream_fetcher(repo, args.remote, True, executor,
+                            branch_prefix, args.branch_suffix, args.lean)
+
+def schedule_all_merges(scheduler, repo, args, refs, executor=None, fetcher=None):
+    """
+    Add the product and deploy merges, and unless args.release_branches is
+    false the release branch chain, to `scheduler`. Release branch pairs
+    that fail submodule verification are added as already failed
+    """
+    schedule_upstream_merges(scheduler, repo, args.remote, refs)
+    if not args.release_branches:
+        return
+    branches = refs.release_branches(args.remote, args.branch_prefix,
+                                     args.branch_suffix)
+    verified = verify_branches(repo, branches, False, args.remote,
+                               executor, fetcher=fetcher)
+    for from_branch, to_branch in zip(branches, branches[1:]):
+        invalid = [branch for branch in (from_branch, to_branch)
+                   if not verified[branch]]
+        if invalid:
+            scheduler.fail(from_branch, to_branch, InvalidSubmoduleBranch(
+                "Invalid submodule branch structure in %s" % ", ".join(invalid)))
+        else:
+            scheduler.add(from_branch, to_branch)
 
 def check_guard_commits(repo, config, branchtype):
     # loop over upstream branch types, checking for guards for any of them:
@@ -237,5 +359,61 @@ def check_guard_commits(repo, config, branchtype):
         if merge_base == guard:
             raise IllegalCommitException("Found guard commit %s (guard for %s): cannot merge this into a %s branch" % (guard, upstream, branchtype))
 
+def configured_guards(config):
+    """
+    The guard commits named in config that can be fetched by sha
+    """
+    return [config.get("guard commits", branchtype)
+            for branchtype in BRANCH_TYPE._merge_order
+            if config.has_option("guard commits", branchtype) and
+            re.match("^[0-9a-f]{40}$", config.get("guard commits", branchtype))]
+
+def guard_commits(repo, config):
+    """
+    The guard commit of each branch type in the "guard commits" section of
+    config, as full shas
+    """
+    guards = {}
+    for branchtype in BRANCH_TYPE._merge_order:
+        if config.has_option("guard commits", branchtype):
+            guard = config.get("guard commits", branchtype)
+            guards[branchtype] = object_queries(repo).rev_parse(guard, "commit")
+    return guards
+
+def find_guard_violations(repo, config, remote=DEFAULT_REMOTE, refs=None):
+    """
+    Check every product and deploy branch against the guard commits of the
+    branch types upstream of it, all in one walk of the commit graph.
+
+    Returns a list of (branch, checks) pairs sorted by branch, where checks
+    is a dict of upstream branch type to whether the branch contains that
+    type's guard commit. Only the guards that apply to the branch are checked
+    """
+    if refs is None:
+        refs = RefSnapshot(repo)
+    guards = guard_commits(repo, config)
+    branches = []
+    for namespace in (PRODUCT_NAMESPACE, DEPLOY_NAMESPACE):
+        for branch in refs.namespace(remote, namespace):
+            branchtype = find_branch_type(branch)
+            if branchtype is not None:
+                branches.append((branch, branchtype))
+    branches.sort()
+
+    reachability = None
+    if guards and branches:
+        reachability = Reachability(
+            repo, [(branch, refs.tip(remote, branch)) for branch, _ in branches],
+            guards.items()).run()
+
+    violations = []
+    for branch, branchtype in branches:
+        checks = {}
+        for upstream in BRANCH_TYPE.upstream_branches(branchtype):
+            if upstream in guards:
+                checks[upstream] = reachability.contains(branch, upstream)
+        violations.append((branch, checks))
+    return violations
+
 if __name__ == "__main__":
     sys.exit(main())
@@ -20,11 +20,24 @@
 #OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 #THE SOFTWARE.
 
+import os
 import re
 import sys
 import logging
-from git import GitCommandError
+import shutil
+import hashlib
+import subprocess
+import tempfile
+import threading
+import Queue
+from bisect import bisect_left, bisect_right
+from git import Git, GitCommandError, Repo
+import release_trace
 from simpleversions import Version
+try:
+    import json
+except ImportError:
+    import simplejson as json
 
 
 class BranchAlreadyExists(Exception):
@@ -39,6 +52,63 @@ class InvalidSubmoduleBranch(Exception):
             'Submodules are in a suboptimal state for branch %s' % branch_name)
 
 
+class SubmoduleCommandError(GitCommandError):
+    """
+    Raised when a command run by a SubmoduleExecutor fails in one or more
+    submodules. `errors` maps each failing submodule path to its exception
+    """
+    def __init__(self, command, errors):
+        self.errors = errors
+        stderr = '\n'.join(['%s: %s' % (path, getattr(error, 'stderr', error))
+                            for path, error in sorted(errors.items())])
+        GitCommandError.__init__(self, command, 1, stderr)
+
+
+class Conflict(object):
+    """
+    Where a deep merge conflicted in one repository: the submodule `path`
+    ('' for the supermodule), the conflicted `files`, and the commits being
+    merged with their merge bases
+    """
+    def __init__(self, path, files, from_sha, to_sha, merge_bases):
+        self.path = path
+        self.files = sorted(files)
+        self.from_sha = from_sha
+        self.to_sha = to_sha
+        self.merge_bases = merge_bases
+
+    def __str__(self):
+        return '%s: %s into %s (base %s): %s' % (
+            self.path or '.', self.from_sha[:10], self.to_sha[:10],
+            ','.join(base[:10] for base in self.merge_bases) or 'none',
+            ', '.join(self.files))
+
+
+class MergeConflict(GitCommandError):
+    """
+    Raised when a deep merge conflicts. `conflicts` has a Conflict for each
+    repository that conflicted, recorded while the merge was in progress,
+    and the message is a compact report of them, one line per repository
+    """
+    def __init__(self, conflicts):
+        self.conflicts = sorted(conflicts, key=lambda conflict: conflict.path)
+        self.report = 'Merge conflict in %s\n%s' % (
+            ', '.join(conflict.path or '.' for conflict in self.conflicts),
+            '\n'.join('  %s' % conflict for conflict in self.conflicts))
+        GitCommandError.__init__(self, ['git', 'merge'], 1, self.report)
+
+    def __str__(self):
+        return self.report
+
+
+DEFAULT_WORKERS = 8
+
+# `git merge-tree --write-tree` first shipped in git 2.38
+TREE_MERGE_GIT_VERSION = (2, 38)
+
+# Lean mode fetches commits and trees, leaving blobs to be fetched on demand
+LEAN_FILTER = 'blob:none'
+
 VERSION = r'\d+([.,]\d+)'
 SUBVERSION = r'[-~_]%s' % VERSION
 
@@ -47,27 +117,892 @@ def branch_pattern(prefix='release_', suffix=''):
     return r'%s%s(%s)*%s' % (prefix, VERSION, SUBVERSION, suffix)
 
 
-def release_branches(repo, remote='origin',
-                     branch_prefix='release_', branch_suffix=''):
-    for branch in repo.git.branch('-r').split('\n'):
-        branch = branch.strip()
-        branch_remote, _, branch_name = branch.partition('/')
-        if branch_remote != remote:
-            continue
+def run_parallel(func, items, max_workers=DEFAULT_WORKERS, name='task'):
+    """
+    Call func(item) for each of `items` on at most `max_workers` threads.
+    Each call is traced as a span called `name` under the caller's span.
 
-        if not re.match(branch_pattern(branch_prefix, branch_suffix),
-                        branch_name):
-            continue
+    Returns a pair of dicts keyed by item: the return values of the calls
+    that succeeded, and the exceptions raised by the calls that failed
+    """
+    items = list(items)
+    parent = release_trace.current()
+    results = {}
+    errors = {}
+    pending = Queue.Queue()
+    for item in items:
+        pending.put(item)
+
+    def worker():
+        while True:
+            try:
+                item = pending.get_nowait()
+            except Queue.Empty:
+                return
+            item_span = release_trace.span(name, parent, item=item)
+            try:
+                results[item] = func(item)
+            except Exception:
+                logging.debug('%r failed' % (item,), exc_info=True)
+                errors[item] = sys.exc_info()[1]
+            item_span.end()
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(max_workers, len(items)))]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, errors
+
+
+class SubmoduleExecutor(object):
+    """
+    Runs per-submodule steps concurrently on a bounded pool of threads,
+    as a parallel replacement for `git submodule foreach`
+    """
+    def __init__(self, repo, max_workers=DEFAULT_WORKERS):
+        self.repo = repo
+        self.max_workers = max_workers
+        self._gits = {}
+        self._paths = None
+        self._gitmodules = None
+
+    def _cached_paths(self):
+        """
+        The paths cached by paths(), or None if there are none or HEAD's
+        .gitmodules has changed since, as a checkout or merge can add or
+        remove submodules
+        """
+        if self._paths is None:
+            return None
+        gitmodules = object_queries(self.repo).resolve('HEAD:.gitmodules')
+        if gitmodules != self._gitmodules:
+            self._paths = None
+        return self._paths
+
+    def paths(self):
+        """
+        The paths of all initialized submodules, as `git submodule foreach`
+        would visit them. Once every submodule is initialized, the answer is
+        cached until HEAD's .gitmodules changes, rather than running
+        `git submodule status` each time
+        """
+        paths = self._cached_paths()
+        if paths is not None:
+            return paths
+        gitmodules = object_queries(self.repo).resolve('HEAD:.gitmodules')
+        status = submodule_status(self.repo)
+        paths = sorted(path for path, (state, _, _) in status.items()
+                       if state != '-')
+        if len(paths) == len(status):
+            self._paths = paths
+            self._gitmodules = gitmodules
+        return paths
+
+    def initialized(self):
+        """
+        Whether every submodule is known to be initialized
+        """
+        return self._cached_paths() is not None
+
+    def git(self, path):
+        if path not in self._gits:
+            self._gits[path] = Git(os.path.join(self.repo.working_tree_dir,
+                                                path))
+        return self._gits[path]
+
+    def run(self, func, paths=None, description=None):
+        """
+        Call func(path, git) for every submodule. All submodules are
+        processed even if some fail; afterwards a SubmoduleCommandError
+        describing every failure is raised. Returns a dict of the results
+        keyed by submodule path
+        """
+        if paths is None:
+            paths = self.paths()
+        # Create the Git objects up front so workers don't race on the cache
+        gits = dict((path, self.git(path)) for path in paths)
+        results, errors = run_parallel(lambda path: func(path, gits[path]),
+                                       paths, self.max_workers, 'submodule')
+        if errors:
+            raise SubmoduleCommandError(description or func.__name__, errors)
+        return results
+
+    def foreach(self, command, *args, **kwargs):
+        """
+        Run `git <command> <args>` in every submodule, or only in those
+        listed in the `paths` keyword argument
+        """
+        paths = kwargs.pop('paths', None)
+
+        def run_command(path, git):
+            logging.debug('%s: git %s %s' % (path, command, ' '.join(args)))
+            return getattr(git, command.replace('-', '_'))(*args, **kwargs)
+        return self.run(run_command, paths,
+                        ' '.join(('git', command) + args))
+
+
+def _git(repo):
+    """
+    The command object for `repo`, which may be a Repo or already a Git
+    """
+    if isinstance(repo, Git):
+        return repo
+    return repo.git
+
+
+class ObjectQueries(object):
+    """
+    Ref and object lookups for one repository, answered by a long-lived
+    `git cat-file --batch-check` (and `--batch`, for object contents)
+    instead of a git process per lookup. Each process is started on first
+    use and restarted if it dies; `started` counts them. Safe to share
+    between threads
+    """
+    def __init__(self, git):
+        self.git = git
+        self.started = 0
+        self.lookups = 0
+        self._processes = {}
+        self._lock = threading.Lock()
+
+    def _process(self, option):
+        process = self._processes.get(option)
+        if process is None or process.proc.poll() is not None:
+            process = self.git.cat_file(option, as_process=True,
+                                        istream=subprocess.PIPE)
+            self._processes[option] = process
+            self.started += 1
+            release_trace.count('cat-file processes')
+        return process
+
+    def _query(self, option, rev):
+        """
+        Send `rev` to the cat-file process for `option`, returning its
+        header fields, or None if `rev` doesn't name an object, and the
+        process for reading any contents. Call with the lock held
+        """
+        if '\n' in rev:
+            raise ValueError('Invalid revision %r' % rev)
+        process = self._process(option)
+        process.proc.stdin.write(rev + '\n')
+        process.proc.stdin.flush()
+        header = process.proc.stdout.readline()
+        self.lookups += 1
+        release_trace.count('object lookups')
+        if not header:
+            raise GitCommandError(['git', 'cat-file', option],
+                                  process.proc.poll(),
+                                  process.proc.stderr.read())
+        fields = header.split()
+        if fields[-1] in ('missing', 'ambiguous'):
+            return None, process
+        return fields, process
+
+    def resolve(self, rev, object_type=None):
+        """
+        The sha `rev` names (peeled to `object_type`, if given), or None if
+        there is no such object
+        """
+        if object_type is not None:
+            rev = '%s^{%s}' % (rev, object_type)
+        self._lock.acquire()
+        try:
+            fields, _ = self._query('--batch-check=%(objectname)', rev)
+        finally:
+            self._lock.release()
+        return fields and fields[0]
+
+    def rev_parse(self, rev, object_type=None):
+        """
+        Like resolve, but raising GitCommandError as `git rev-parse` would
+        if there is no such object
+        """
+        sha = self.resolve(rev, object_type)
+        if sha is None:
+            raise GitCommandError(['git', 'rev-parse', rev], 128,
+                                  "unknown revision '%s'" % rev)
+        return sha
+
+    def read(self, rev):
+        """
+        The type and contents of the object `rev` names, or None if there
+        is no such object
+        """
+        self._lock.acquire()
+        try:
+            fields, process = self._query('--batch', rev)
+            if fields is None:
+                return None
+            size = int(fields[2])
+            contents = process.proc.stdout.read(size)
+            # Each object is followed by a newline
+            process.proc.stdout.read(1)
+        finally:
+            self._lock.release()
+        return fields[1], contents
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            for process in self._processes.values():
+                process.proc.stdin.close()
+                process.proc.wait()
+            self._processes = {}
+        finally:
+            self._lock.release()
+
+
+_object_queries = {}
+_object_queries_lock = threading.Lock()
+
+
+def object_queries(repo):
+    """
+    The ObjectQueries shared by everything working on `repo` (a Repo or a
+    Git) in this process
+    """
+    git = _git(repo)
+    key = os.path.abspath(git._working_dir or os.getcwd())
+    _object_queries_lock.acquire()
+    try:
+        if key not in _object_queries:
+            _object_queries[key] = ObjectQueries(git)
+        return _object_queries[key]
+    finally:
+        _object_queries_lock.release()
+
+
+def object_query_processes():
+    """
+    How many `git cat-file` processes object_queries has started
+    """
+    return sum(queries.started for queries in _object_queries.values())
+
+
+def close_object_queries():
+    """
+    Stop every process started by object_queries, e.g. before the
+    repositories they read are deleted
+    """
+    _object_queries_lock.acquire()
+    try:
+        queries = _object_queries.values()
+        _object_queries.clear()
+    finally:
+        _object_queries_lock.release()
+    started = 0
+    for each in queries:
+        started += each.started
+        each.close()
+    logging.debug('Closed object queries after starting %s git cat-file '
+                  'processes' % started)
+
+
+def _ref_pattern_matches(pattern, refname):
+    """
+    Match `refname` against `pattern` the way `git for-each-ref` does: glob
+    patterns are matched with `*` not crossing a `/`, anything else must
+    match completely or from the beginning up to a slash
+    """
+    if re.search(r'[*?]', pattern):
+        regex = re.escape(pattern).replace(r'\*', '[^/]*') \
+                                  .replace(r'\?', '[^/]')
+        return re.match(regex + '$', refname) is not None
+    if not refname.startswith(pattern):
+        return False
+    return (len(refname) == len(pattern) or pattern.endswith('/') or
+            refname[len(pattern)] == '/')
+
+
+class RefSnapshot(object):
+    """
+    All of the refs in a repository, read with a single `git for-each-ref`
+    and indexed for the branch lookups done by release_path and
+    release_branch_manager. Remote branches are indexed by remote, by their
+    first path component (the `product/` and `deploy/` namespaces), by their
+    last path component (the branch type) and, on demand, by release version
+    """
+    def __init__(self, repo):
+        self.shas = {}
+        self.by_remote = {}
+        self.by_namespace = {}
+        self.by_type = {}
+        self._versions = {}
+
+        output = _git(repo).for_each_ref('--format=%(refname) %(objectname)')
+        for line in output.split('\n'):
+            if not line:
+                continue
+            refname, _, sha = line.partition(' ')
+            self.shas[refname] = sha
+            if not refname.startswith('refs/remotes/'):
+                continue
+            remote, _, branch = refname[len('refs/remotes/'):].partition('/')
+            self.by_remote.setdefault(remote, {})[branch] = sha
+            if '/' in branch:
+                namespace = branch.split('/')[0]
+                branchtype = branch.split('/')[-1]
+                self.by_namespace.setdefault(
+                    (remote, namespace), []).append(branch)
+                self.by_type.setdefault(
+                    (remote, branchtype), []).append(branch)
+        logging.debug('Read %s refs' % len(self.shas))
+
+    def tip(self, remote, branch):
+        """
+        The sha of `remote`/`branch`, or None if there is no such branch
+        """
+        return self.by_remote.get(remote, {}).get(branch)
+
+    def branches(self, remote):
+        return sorted(self.by_remote.get(remote, {}).keys())
+
+    def match(self, remote, pattern=None):
+        """
+        Branches of `remote` matching the for-each-ref style `pattern`
+        """
+        if pattern is None:
+            return self.branches(remote)
+        return [branch for branch in self.branches(remote)
+                if _ref_pattern_matches(pattern, branch)]
+
+    def namespace(self, remote, namespace, branchtype=None):
+        """
+        Branches of `remote` under `namespace`/, optionally only those whose
+        last path component is `branchtype`
+        """
+        branches = self.by_namespace.get((remote, namespace), [])
+        if branchtype is not None:
+            branches = [branch for branch in branches
+                        if branch.split('/')[-1] == branchtype]
+        return sorted(branches)
+
+    def of_type(self, remote, branchtype):
+        return sorted(self.by_type.get((remote, branchtype), []))
+
+    def _version_index(self, remote, branch_prefix, branch_suffix):
+        key = (remote, branch_prefix, branch_suffix)
+        if key not in self._versions:
+            pattern = branch_pattern(branch_prefix, branch_suffix)
+            index = sorted((Version(branch), branch)
+                           for branch in self.branches(remote)
+                           if re.match(pattern, branch))
+            self._versions[key] = ([version for version, _ in index],
+                                   [branch for _, branch in index])
+        return self._versions[key]
+
+    def release_branches(self, remote='origin', branch_prefix='release_',
+                         branch_suffix='', min_version=None,
+                         max_version=None):
+        """
+        Release branches of `remote` in version order, optionally limited to
+        those between `min_version` and `max_version` inclusive
+        """
+        versions, branches = self._version_index(remote, branch_prefix,
+                                                 branch_suffix)
+        start = 0
+        end = len(versions)
+        if min_version is not None:
+            start = bisect_left(versions, min_version)
+        if max_version is not None:
+            end = bisect_right(versions, max_version)
+        return branches[start:end]
+
+
+class StateFile(object):
+    """
+    A JSON document kept under .git/release-path in `repo`, used to
+    remember results between runs. Each entry records the last run that
+    used it, and saving keeps at most `max_entries` of the most recently
+    used ones
+    """
+    def __init__(self, repo, name, max_entries=10000):
+        self.path = os.path.join(repo.git_dir, 'release-path', name)
+        self.max_entries = max_entries
+        self.entries = {}
+        self.run = 0
+        if os.path.exists(self.path):
+            try:
+                data = json.load(open(self.path))
+                self.entries = data['entries']
+                self.run = data['run']
+            except (ValueError, KeyError):
+                logging.warning('Ignoring unreadable state file %s' %
+                                self.path)
+        self.run += 1
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        if key not in self.entries:
+            return default
+        self.entries[key]['used'] = self.run
+        return self.entries[key]['value']
+
+    def set(self, key, value):
+        self.entries[key] = {'used': self.run, 'value': value}
+
+    def retain(self, keys):
+        """
+        Drop every entry whose key is not in `keys`
+        """
+        keys = set(keys)
+        for key in list(self.entries):
+            if key not in keys:
+                del self.entries[key]
+
+    def save(self):
+        if self.max_entries is not None and \
+                len(self.entries) > self.max_entries:
+            by_use = sorted(self.entries,
+                            key=lambda key: self.entries[key]['used'])
+            for key in by_use[:len(self.entries) - self.max_entries]:
+                del self.entries[key]
+
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Write to a temporary file first so readers never see half a file
+        temp_path = '%s.%s.tmp' % (self.path, os.getpid())
+        temp_file = open(temp_path, 'w')
+        try:
+            json.dump({'run': self.run, 'entries': self.entries}, temp_file)
+        finally:
+            temp_file.close()
+        os.rename(temp_path, self.path)
+
+
+class MergeHistory(object):
+    """
+    The outcome of the last attempt at each (from_branch, to_branch) merge,
+    kept in .git/release-path/merge-history.json along with the remote tips
+    of both branches in the supermodule and every submodule. A merge whose
+    branches haven't moved anywhere since would have the same outcome, so
+    `last_result` returns it; with `force`, nothing is taken as known.
 
+    Record results after refresh() has read the tips the merges left
+    behind, so a successful merge isn't attempted again next run. Only
+    record failures that would recur at the same tips, such as conflicts
+    """
+    def __init__(self, repo, remote='origin', executor=None, force=False):
+        self.repo = repo
+        self.remote = remote
+        self.executor = executor or SubmoduleExecutor(repo)
+        self.force = force
+        self.state = StateFile(repo, 'merge-history.json')
+        self.refresh()
+
+    def refresh(self):
+        self.refs = {'': RefSnapshot(self.repo)}
+        self.refs.update(self.executor.run(
+            lambda path, git: RefSnapshot(git), description='for-each-ref'))
+
+    def _inputs(self, from_branch, to_branch):
+        digest = hashlib.sha1()
+        for path in sorted(self.refs):
+            digest.update('%s %s %s\n' % (
+                path, self.refs[path].tip(self.remote, from_branch),
+                self.refs[path].tip(self.remote, to_branch)))
+        return digest.hexdigest()
+
+    def last_result(self, from_branch, to_branch):
+        """
+        A dict with 'succeeded' and 'error' for the last attempt at this
+        merge, or None unless neither branch has moved since
+        """
+        if self.force:
+            return None
+        entry = self.state.get('%s..%s' % (from_branch, to_branch))
+        if entry is None or \
+                entry['inputs'] != self._inputs(from_branch, to_branch):
+            return None
+        return entry
+
+    def record(self, from_branch, to_branch, succeeded, error=None):
+        self.state.set('%s..%s' % (from_branch, to_branch), {
+            'inputs': self._inputs(from_branch, to_branch),
+            'succeeded': succeeded,
+            'error': error,
+        })
+
+    def save(self):
+        self.state.save()
+
+
+def release_refspecs(remote='origin', branch_prefix='release_',
+                     branch_suffix='', branches=(), namespaces=()):
+    """
+    Fetch refspecs covering the release branches matched by
+    branch_pattern(branch_prefix, branch_suffix) (unless branch_prefix is
+    None), the named `branches`, and every branch under each of `namespaces`
+    """
+    globs = []
+    if branch_prefix is not None:
+        globs.append('%s*%s' % (branch_prefix, branch_suffix))
+    globs.extend(['%s/*' % namespace for namespace in namespaces])
+    return (['+refs/heads/%s:refs/remotes/%s/%s' % (glob, remote, glob)
+             for glob in globs] +
+            ['+refs/heads/%s:refs/remotes/%s/%s' % (branch, remote, branch)
+             for branch in branches])
+
+
+class FetchCoordinator(object):
+    """
+    Fetches the supermodule and all of its submodules at most once per run,
+    in parallel, limited to `refspecs` (all of the remote's configured refs
+    if None). Library functions that are handed a coordinator fetch through
+    it, so refs that are already fresh aren't fetched again.
+
+    In `lean` mode every fetch is blobless, turning the repositories into
+    partial clones if they aren't already, and the supermodule `commits`
+    (such as guard commits) are fetched by sha if they're missing
+    """
+    def __init__(self, repo, remote='origin', refspecs=None, executor=None,
+                 submodules=True, prune=False, lean=False, commits=()):
+        self.repo = repo
+        self.remote = remote
+        self.refspecs = refspecs
+        self.executor = executor or SubmoduleExecutor(repo)
+        self.submodules = submodules
+        self.prune = prune
+        self.lean = lean
+        self.commits = list(commits)
+        self.fetched = False
+
+    def mark_fresh(self):
+        """
+        Treat the refs as fresh without fetching, e.g. for --no-fetch
+        """
+        self.fetched = True
+
+    def fetch(self, force=False):
+        if self.fetched and not force:
+            logging.debug('Refs already fetched this run')
+            return
+        args = [self.remote] + list(self.refspecs or [])
+        if self.prune:
+            args.insert(0, '--prune')
+        if self.lean:
+            args.insert(0, '--filter=%s' % LEAN_FILTER)
+
+        paths = [None]
+        if self.submodules:
+            init_submodules(self.repo, True, self.lean, self.executor)
+            paths.extend(self.executor.paths())
+
+        def fetch_one(path):
+            if path is None:
+                return self.repo.git.fetch(*args)
+            return self.executor.git(path).fetch(*args)
+
+        logging.info('Fetching %s in %s repositories' %
+                     (self.remote, len(paths)))
+        fetch_span = release_trace.span('fetch', remote=self.remote)
+        _, errors = run_parallel(fetch_one, paths,
+                                 self.executor.max_workers, 'repository')
+        fetch_span.end()
+        if errors:
+            raise SubmoduleCommandError(
+                'fetch %s' % ' '.join(args),
+                dict(((path or '.'), error)
+                     for path, error in errors.items()))
+        self._fetch_commits()
+        self.fetched = True
+
+    def _fetch_commits(self):
+        queries = object_queries(self.repo)
+        missing = [commit for commit in self.commits
+                   if queries.resolve(commit, 'commit') is None]
+        if not missing:
+            return
+        args = [self.remote] + missing
+        if self.lean:
+            args.insert(0, '--filter=%s' % LEAN_FILTER)
+        logging.info('Fetching %s missing commits from %s' %
+                     (len(missing), self.remote))
+        self.repo.git.fetch(*args)
+
+
+class PushQueue(object):
+    """
+    Collects the branch updates made during a run so they can be pushed
+    together: one `git push --atomic` per repository, with the submodules
+    pushed in parallel before the supermodule. Repositories are identified
+    by submodule path, or '' for the supermodule
+    """
+    def __init__(self, repo, remote='origin', executor=None):
+        self.repo = repo
+        self.remote = remote
+        self.executor = executor or SubmoduleExecutor(repo)
+        self.pending = {}
+
+    def add(self, path, branch, sha):
+        self.pending.setdefault(path, {})[branch] = sha
+
+    def tip(self, path, branch):
+        """
+        The commit queued for `branch` in the repository at `path`, if any
+        """
+        return self.pending.get(path, {}).get(branch)
+
+    def updated(self, branch):
+        """
+        Whether an update to `branch` is queued in any repository
+        """
+        return bool([path for path in self.pending
+                     if branch in self.pending[path]])
+
+    def flush(self):
+        """
+        Push everything queued. Returns a pair of lists: the accepted
+        (path, branch, sha) updates and the rejected (path, branch, reason)
+        ones
+        """
+        push_span = release_trace.span('push', remote=self.remote)
+        try:
+            return self._flush()
+        finally:
+            push_span.end()
+
+    def _flush(self):
+        accepted = []
+        rejected = []
+        submodules = [path for path in self.pending if path != '']
+        results, errors = run_parallel(self._push, submodules,
+                                       self.executor.max_workers,
+                                       'repository')
+        for path in submodules:
+            if path in errors:
+                results[path] = ([], [(path, branch, str(errors[path]))
+                                      for branch in self.pending[path]])
+            accepted.extend(results[path][0])
+            rejected.extend(results[path][1])
+
+        if '' in self.pending:
+            if rejected:
+                # Don't publish gitlinks to submodule commits the remote
+                # doesn't have
+                rejected.extend([('', branch, 'submodule push rejected')
+                                 for branch in self.pending['']])
+            else:
+                pushed, failed = self._push('')
+                accepted.extend(pushed)
+                rejected.extend(failed)
+
+        for path, branch, reason in rejected:
+            logging.error('Push of %s to %s in %s rejected: %s' %
+                          (branch, self.remote, path or '.', reason))
+        self.pending = {}
+        return accepted, rejected
+
+    def _push(self, path):
+        git = self.repo.git
+        if path != '':
+            git = self.executor.git(path)
+        updates = self.pending[path]
+        refspecs = ['%s:refs/heads/%s' % (sha, branch)
+                    for branch, sha in sorted(updates.items())]
+        status, output, stderr = git.push(
+            '--atomic', '--porcelain', self.remote, *refspecs,
+            with_extended_output=True, with_exceptions=False)
+        if status != 0 and 'does not support --atomic' in stderr:
+            status, output, stderr = git.push(
+                '--porcelain', self.remote, *refspecs,
+                with_extended_output=True, with_exceptions=False)
+
+        accepted = []
+        rejected = []
+        reported = set()
+        for line in output.split('\n'):
+            fields = line.split('\t')
+            if len(fields) < 3:
+                continue
+            flag, refs, summary = fields[:3]
+            branch = refs.partition(':')[2][len('refs/heads/'):]
+            reported.add(branch)
+            if flag == '!':
+                rejected.append((path, branch, summary))
+            else:
+                accepted.append((path, branch, updates[branch]))
+        for branch in updates:
+            if branch not in reported:
+                rejected.append((path, branch, stderr.strip()))
+        return accepted, rejected
+
+
+class Reachability(object):
+    """
+    Works out which of many `sources` contain each of many `targets` with a
+    single `git rev-list --topo-order --parents` walk, rather than one git
+    command per source or target. `sources` and `targets` are sequences of
+    (name, sha) pairs.
+
+    The walk carries a bitset of the sources that reach each commit from
+    child to parents; --topo-order guarantees a commit's bitset is complete
+    by the time it is read, so each target's answer is known as soon as its
+    tip comes out of the stream.
+
+    If `author_base` names one of the sources, the same walk also counts
+    the authors of the commits on each target that aren't reachable from
+    that source (as `git log base..target --format=%ae` would)
+    """
+    def __init__(self, repo, sources, targets, author_base=None):
+        self.repo = repo
+        self.sources = list(sources)
+        self.targets = list(targets)
+        self.author_base = author_base
+        self.masks = {}
+        self.authors = {}
+        self.tip_authors = {}
+        self.commits = 0
+        self._source_bits = dict((name, 1 << index) for index, (name, _)
+                                 in enumerate(self.sources))
+
+    def contains(self, source, target):
+        """
+        Whether the tip of `target` is an ancestor of the tip of `source`
+        """
+        return bool(self.masks.get(target, 0) & self._source_bits[source])
+
+    def owners(self, target):
+        """
+        (count, email) pairs for the authors of `target`, most prolific
+        first, falling back to the author of its tip
+        """
+        counts = self.authors.get(target)
+        if not counts:
+            if target not in self.tip_authors:
+                return []
+            counts = {self.tip_authors[target]: 1}
+        return sorted(((count, email) for email, count in counts.items()),
+                      reverse=True)
+
+    def run(self):
+        for _ in self.walk():
+            pass
+        return self
+
+    def walk(self):
+        """
+        Yield (target, mask) pairs, where `mask` has bit i set if
+        self.sources[i] contains the target, as soon as each is known
+        """
+        source_bits = {}
+        for name, sha in self.sources:
+            source_bits[sha] = source_bits.get(sha, 0) | \
+                self._source_bits[name]
+        target_names = {}
+        for name, sha in self.targets:
+            target_names.setdefault(sha, []).append(name)
+
+        counting = self.author_base is not None
+        tips = set(source_bits)
+        target_bits = {}
+        counted = []
+        if counting:
+            base_bit = self._source_bits[self.author_base]
+            tips.update(target_names)
+            counted = [name for name, _ in self.targets]
+            for index, (_, sha) in enumerate(self.targets):
+                target_bits[sha] = target_bits.get(sha, 0) | (1 << index)
+
+        pending = {}
+        # How many of the pending commits still carry owned bits
+        owning = 0
+        remaining = len(self.targets)
+        for sha, parents, author in self._commits(tips):
+            self.commits += 1
+            reached, owned = pending.pop(sha, (0, 0))
+            if owned:
+                owning -= 1
+            reached |= source_bits.get(sha, 0)
+            if counting:
+                owned |= target_bits.get(sha, 0)
+                if reached & base_bit:
+                    # Already released, so not evidence of ownership
+                    owned = 0
+                bits = owned
+                while bits:
+                    lowest = bits & -bits
+                    counts = self.authors.setdefault(
+                        counted[len(bin(lowest)) - 3], {})
+                    counts[author] = counts.get(author, 0) + 1
+                    bits ^= lowest
+
+            for name in target_names.get(sha, ()):
+                self.masks[name] = reached
+                self.tip_authors[name] = author
+                remaining -= 1
+                yield name, reached
+
+            if reached or owned:
+                for parent in parents:
+                    parent_reached, parent_owned = pending.get(parent, (0, 0))
+                    if owned and not parent_owned:
+                        owning += 1
+                    pending[parent] = (parent_reached | reached,
+                                       parent_owned | owned)
+
+            if not remaining and not owning:
+                # Every answer is already known
+                break
+
+        for name, _ in self.targets:
+            if name not in self.masks:
+                self.masks[name] = 0
+                yield name, 0
+        logging.debug('Walked %s commits' % self.commits)
+
+    def _commits(self, tips):
+        """
+        Yield (sha, parents, author email) for every commit reachable from
+        `tips`, children before parents
+        """
+        if not tips:
+            return
+        process = _git(self.repo).rev_list(
+            '--topo-order', '--parents', '--format=%ae', '--stdin',
+            as_process=True, istream=subprocess.PIPE)
+        process.proc.stdin.write(''.join(tip + '\n' for tip in tips))
+        process.proc.stdin.close()
+        lines = iter(process.proc.stdout)
+        try:
+            for header in lines:
+                shas = header.split()[1:]
+                author = lines.next().strip()
+                yield shas[0], shas[1:], author
+        finally:
+            process.proc.stdout.close()
+            status = process.proc.wait()
+        # Only reached if the whole stream was read
+        if status != 0:
+            raise GitCommandError(['git', 'rev-list', '--stdin'], status,
+                                  process.proc.stderr.read())
+
+
+def release_branches(repo, remote='origin',
+                     branch_prefix='release_', branch_suffix='', refs=None):
+    if refs is None:
+        refs = RefSnapshot(repo)
+    for branch_name in refs.release_branches(remote, branch_prefix,
+                                             branch_suffix):
         yield branch_name
 
 
 def create_release_branch(repo, version, remote='origin',
-                          branch_prefix='release_', branch_suffix=''):
+                          branch_prefix='release_', branch_suffix='',
+                          executor=None, fetcher=None):
     new_branch = Version(branch_prefix + version + branch_suffix)
     branch_point = None
 
-    repo.git.fetch()
+    if fetcher is None:
+        repo.git.fetch()
+    else:
+        fetcher.fetch()
 
     for branch_name in release_branches(repo, remote, branch_prefix,
                                         branch_suffix):
@@ -87,23 +1022,76 @@ def create_release_branch(repo, version, remote='origin',
 
     remote_old_branch = '/'.join((remote, str(branch_point)))
     repo.git.branch(str(new_branch), remote_old_branch)
-    repo.git.submodule('foreach',
-                       'git branch %s %s' % (new_branch, remote_old_branch))
+    (executor or SubmoduleExecutor(repo)).foreach(
+        'branch', str(new_branch), remote_old_branch)
 
     return str(branch_point), str(new_branch)
 
 
-def merge_branches(repo, branches, remote='origin', push=True, fetch=True):
-    verified = {}
-    for branch in branches:
-        try:
-            verify_submodule_branch_structure(repo, branch, fetch)
-            verified[branch] = True
-        except InvalidSubmoduleBranch:
-            verified[branch] = False
+def merge_branches(repo, branches, remote='origin', push=True, fetch=True,
+                   executor=None, fetcher=None, history=None):
+    """
+    Merge each of `branches` into the next, returning the (from_branch,
+    to_branch) pairs that failed. Branch updates are collected and pushed
+    together at the end, one atomic push per repository, unless `push` is
+    false. Without pushing, merges are only done in memory; those that would
+    need the working tree fail instead.
+
+    If `history` is a MergeHistory, pairs whose branches haven't moved since
+    the last run are skipped, and reported as failed if they failed then
+    """
+    executor = executor or SubmoduleExecutor(repo)
+    pushes = PushQueue(repo, remote, executor)
+    pairs = zip(branches, branches[1:])
+
+    verified = verify_branches(repo, list(branches), fetch, remote, executor,
+                               fetcher=fetcher)
+
+    # Plan every merge that can go ahead before doing any of them. Pairs
+    # the history already knows about are left out, unless an earlier merge
+    # will have moved one of their branches by the time they come up
+    plan = {}
+    moving = set()
+    planner = MergePlanner(repo, remote, executor)
+    plan_span = release_trace.span('plan')
+    try:
+        for from_branch, to_branch in pairs:
+            if not (verified[from_branch] and verified[to_branch]):
+                continue
+            if history is not None and from_branch not in moving and \
+                    to_branch not in moving and \
+                    history.last_result(from_branch, to_branch) is not None:
+                continue
+            for step in planner.plan([(from_branch, to_branch)]):
+                logging.info('Planned %s' % step)
+                plan[(from_branch, to_branch)] = step.action
+                if step.action != NO_OP:
+                    moving.add(to_branch)
+    finally:
+        plan_span.end()
 
+    attempted = []
     failed_merges = []
-    for from_branch, to_branch in zip(branches, branches[1:]):
+    unrecorded = []
+    for from_branch, to_branch in pairs:
+        # A branch updated earlier in this run has moved since the last
+        # one, whatever the remote tips say
+        known = None
+        if history is not None and not pushes.updated(from_branch) and \
+                not pushes.updated(to_branch):
+            known = history.last_result(from_branch, to_branch)
+        if known is not None:
+            if known['succeeded']:
+                logging.info('Skipping merge from %s into %s: already merged '
+                             'at these tips' % (from_branch, to_branch))
+            else:
+                logging.error('Skipping merge from %s into %s: it failed at '
+                              'these tips last time' %
+                              (from_branch, to_branch))
+                failed_merges.append((from_branch, to_branch))
+            continue
+        attempted.append((from_branch, to_branch))
+
         if not verified[from_branch]:
             logging.error('Unable to merge from branch %s due to invalid '
                           'submodule branch' % from_branch)
@@ -116,41 +1104,132 @@ def merge_branches(repo, branches, remote='origin', push=True, fetch=True):
             failed_merges.append((from_branch, to_branch))
             continue
 
+        if plan[(from_branch, to_branch)] == NO_OP:
+            continue
+
         try:
             logging.info('Merging %s into %s' % (from_branch, to_branch))
-            deep_merge(repo, from_branch, to_branch, remote)
-            if push:
-                repo.git.push(remote, to_branch)
+            _run_planned(repo, from_branch, to_branch,
+                         plan[(from_branch, to_branch)], remote, executor,
+                         pushes=pushes, push=push)
 
         except GitCommandError:
             logging.exception('Failed to merge %s into %s\nStderr:\n%s' %
                               (from_branch, to_branch,
                                sys.exc_info()[1].stderr))
             failed_merges.append((from_branch, to_branch))
+            if not _lasting_failure(sys.exc_info()[1]):
+                unrecorded.append((from_branch, to_branch))
+
+    if push and pushes.pending:
+        accepted, rejected = pushes.flush()
+        for path, branch, sha in accepted:
+            logging.info('Pushed %s to %s/%s in %s' %
+                         (sha, remote, branch, path or '.'))
+        rejected_branches = set(branch for _, branch, _ in rejected)
+        for from_branch, to_branch in zip(branches, branches[1:]):
+            if to_branch in rejected_branches:
+                unrecorded.append((from_branch, to_branch))
+                if (from_branch, to_branch) not in failed_merges:
+                    failed_merges.append((from_branch, to_branch))
+
+    # Results can only be matched against the remote tips once they're
+    # pushed, and a rejected push says nothing about the merge itself
+    if history is not None and push:
+        history.refresh()
+        for from_branch, to_branch in attempted:
+            if (from_branch, to_branch) not in unrecorded:
+                history.record(from_branch, to_branch,
+                               (from_branch, to_branch) not in failed_merges)
+        history.save()
 
     return failed_merges
 
 
-def no_ff_deep_merge(repo, from_branch, to_branch, remote='origin'):
+def fetch_release_branches(repo, remote='origin', branch_prefix='release_',
+                           branch_suffix='', min_version=None,
+                           max_version=None, extra_branches=(), fetch=True,
+                           executor=None, lean=False):
+    """
+    Fetch the release branches and `extra_branches` of the supermodule and
+    every submodule (or just prune stale ones, unless `fetch`), returning
+    the branches to merge, in order, and the FetchCoordinator used
+    """
+    executor = executor or SubmoduleExecutor(repo)
+    fetcher = FetchCoordinator(
+        repo, remote,
+        release_refspecs(remote, branch_prefix, branch_suffix,
+                         extra_branches),
+        executor, prune=True, lean=lean)
+
+    if fetch:
+        fetcher.fetch()
+    else:
+        repo.git.remote('prune', remote)
+
+    branches = RefSnapshot(repo).release_branches(
+        remote, branch_prefix, branch_suffix, min_version, max_version)
+    branches.extend(extra_branches)
+    return branches, fetcher
+
+
+def merge_release_path(repo, remote='origin', branch_prefix='release_',
+                       branch_suffix='', min_version=None, max_version=None,
+                       extra_branches=(), push=True, fetch=True,
+                       jobs=DEFAULT_WORKERS, lean=False, force=False):
+    """
+    Everything merge_release_branches does for one repository: fetch, then
+    merge each release branch into the next, skipping merges whose branches
+    haven't moved since the last run unless `force`. Lean mode is used if
+    asked for or if `repo` is a partial clone. Returns the (from_branch,
+    to_branch) pairs that failed
+    """
+    executor = SubmoduleExecutor(repo, jobs)
+    lean = lean or is_partial_clone(repo, remote)
+    if lean:
+        require_lean_support(repo)
+    branches, fetcher = fetch_release_branches(
+        repo, remote, branch_prefix, branch_suffix, min_version, max_version,
+        extra_branches, fetch, executor, lean)
+    history = MergeHistory(repo, remote, executor, force)
+    return merge_branches(repo, branches, remote, push, fetch, executor,
+                          fetcher, history)
+
+
+def unmerged_commits(repo, from_branch, to_branch, remote='origin'):
+    """
+    One line per commit on `remote`/`from_branch` that isn't on
+    `remote`/`to_branch`: abbreviated sha, author and subject
+    """
+    return repo.git.log('%s/%s..%s/%s' % (remote, to_branch,
+                                          remote, from_branch),
+                        '--format=%h - %an - %s').split('\n')
+
+
+def no_ff_deep_merge(repo, from_branch, to_branch, remote='origin',
+                     executor=None):
     """
     Merge from_branch into to_branch, while also merge from_branch into
-    to_branch in each of the submodules of this repository
+    to_branch in each of the submodules of this repository.
+
+    The merges are done on a detached HEAD and pushed from there, so they
+    work in a linked worktree even when to_branch is checked out in another
     """
+    executor = executor or SubmoduleExecutor(repo)
 
     remote_from_branch = "%s/%s" % (remote, from_branch)
     remote_to_branch = "%s/%s" % (remote, to_branch)
 
-    # Prepare to merge to to_branch by clearing out any local changes
-    repo.git.reset('--hard', 'HEAD')
-    repo.git.checkout('-f', to_branch)
-    repo.git.reset('--hard', remote_to_branch)
-
     # If there have been no commits on from_branch that aren't on to_branch,
     # then we don't need to merge at all
     if not repo.git.log(remote_from_branch, "^%s" % remote_to_branch,
                         '--oneline'):
         return
 
+    # Prepare to merge to to_branch by clearing out any local changes
+    repo.git.reset('--hard', 'HEAD')
+    repo.git.checkout('-f', '--detach', remote_to_branch)
+
     try:
         # Merge from from_branch, but leave the commit open to include
         # the submodule merges. Even if the merge is in conflict,
@@ -161,32 +1240,45 @@ def no_ff_deep_merge(repo, from_branch, to_branch, remote='origin'):
         # Prepare submodules for merge to to_branch. Assumes that
         # submodule branch structure has been verified by
         # verify_submodule_branch_structure
-        repo.git.submodule('foreach', "git checkout -f %s" % to_branch)
-        repo.git.submodule('foreach', "git reset --hard %s" % remote_to_branch)
+        executor.foreach('checkout', '-f', '--detach', remote_to_branch)
 
-        repo.git.submodule('foreach', "git merge %s" % remote_from_branch)
+        executor.foreach('merge', remote_from_branch)
         # If there are any changes recorded, then commit
         if repo.git.status('-s') != []:
-            for path in submodule_status(repo).keys():
+            for path in executor.paths():
                 repo.git.add(path)
             repo.git.commit(
                 '-m', "deep merged %s to %s" % (from_branch, to_branch),
                 '--allow-empty')
 
         # Push all changes (this is a no-op if there are no changes)
-        repo.git.submodule('foreach', "git push origin %s" % to_branch)
-        repo.git.push('origin', to_branch)
+        executor.foreach('push', 'origin', 'HEAD:refs/heads/%s' % to_branch)
+        repo.git.push('origin', 'HEAD:refs/heads/%s' % to_branch)
     except:
+        error = sys.exc_info()
+        # Record the conflicts while they're still in the working trees
+        conflicts = []
+        try:
+            conflicts = _working_tree_conflicts(repo, executor,
+                                                remote_from_branch,
+                                                remote_to_branch)
+        except GitCommandError:
+            logging.exception('Unable to read the merge conflicts')
+
         # Merge failed, reset the repo
         repo.git.reset('--hard', 'HEAD')
-        repo.git.submodule('foreach', "git reset --hard HEAD")
-        raise
+        executor.foreach('reset', '--hard', 'HEAD')
+        if conflicts:
+            raise MergeConflict(conflicts)
+        raise error[0], error[1], error[2]
 
 
-def fast_forward_deep_merge(repo, from_branch, to_branch, remote='origin'):
+def fast_forward_deep_merge(repo, from_branch, to_branch, remote='origin',
+                            executor=None):
     """
     Do a fast-forward merge of the supermodule and submodules
     """
+    executor = executor or SubmoduleExecutor(repo)
     remote_from_branch = "%s/%s" % (remote, from_branch)
     remote_to_branch = "%s/%s" % (remote, to_branch)
 
@@ -198,29 +1290,859 @@ def fast_forward_deep_merge(repo, from_branch, to_branch, remote='origin'):
     repo.git.merge('--ff-only', remote_from_branch)
 
     # Prep the submodules
-    repo.git.submodule('foreach', 'git checkout -f ' + to_branch)
-    repo.git.submodule('foreach', 'git reset --hard ' + remote_to_branch)
+    executor.foreach('checkout', '-f', to_branch)
+    executor.foreach('reset', '--hard', remote_to_branch)
 
     # FF merge the submodules
-    repo.git.submodule('foreach', 'git merge --ff-only ' + remote_from_branch)
+    executor.foreach('merge', '--ff-only', remote_from_branch)
 
     # Push all the changes
-    repo.git.submodule('foreach', 'git push origin ' + to_branch)
+    executor.foreach('push', 'origin', to_branch)
     repo.git.push('origin', to_branch)
 
 
-def deep_merge(repo, from_branch, to_branch, remote='origin'):
+def supports_tree_merge(repo):
+    """
+    Whether the installed git can merge without a working tree
+    """
+    return tuple(_git(repo).version_info[:2]) >= TREE_MERGE_GIT_VERSION
+
+
+def require_lean_support(repo):
+    """
+    Raise unless merges can be done in lean mode: in memory, so only the
+    blobs of files that really need a content merge are fetched, rather
+    than everything a checkout would need
+    """
+    if not supports_tree_merge(repo):
+        raise Exception('Lean mode needs git %s or newer, for merges without '
+                        'a working tree' %
+                        '.'.join(map(str, TREE_MERGE_GIT_VERSION)))
+
+
+def is_partial_clone(repo, remote='origin'):
+    """
+    Whether objects missing from `repo` are fetched from `remote` on demand
+    """
+    status, promisor, _ = _git(repo).config(
+        '--get', 'remote.%s.promisor' % remote,
+        with_extended_output=True, with_exceptions=False)
+    return status == 0 and promisor.strip() == 'true'
+
+
+def is_ancestor(repo, ancestor, descendant):
+    status, _, stderr = _git(repo).merge_base(
+        '--is-ancestor', ancestor, descendant,
+        with_extended_output=True, with_exceptions=False)
+    if status not in (0, 1):
+        raise GitCommandError(['git', 'merge-base', '--is-ancestor',
+                               ancestor, descendant], status, stderr)
+    return status == 0
+
+
+def gitlinks(repo, treeish):
+    """
+    Map of submodule path to the commit recorded for it in `treeish`
+    """
+    links = {}
+    for entry in _git(repo).ls_tree('-r', '-z', treeish).split('\0'):
+        if not entry:
+            continue
+        info, _, path = entry.partition('\t')
+        _, object_type, sha = info.split()
+        if object_type == 'commit':
+            links[path] = sha
+    return links
+
+
+def merge_tree(repo, to_sha, from_sha):
+    """
+    Merge `from_sha` into `to_sha` with `git merge-tree`, without touching
+    any working tree or index.
+
+    Returns the resulting tree and a list of (mode, path) pairs, one for
+    each side of every conflicted path. When there are conflicts, the tree
+    contains conflict markers
+    """
+    status, output, stderr = _git(repo).merge_tree(
+        '--write-tree', to_sha, from_sha,
+        with_extended_output=True, with_exceptions=False)
+    if status not in (0, 1):
+        raise GitCommandError(['git', 'merge-tree', '--write-tree',
+                               to_sha, from_sha], status, stderr)
+
+    lines = output.split('\n')
+    conflicts = []
+    if status == 1:
+        # Conflicted file info follows the tree, up to the first blank line
+        for line in lines[1:]:
+            if not line:
+                break
+            info, _, path = line.partition('\t')
+            conflicts.append((info.split()[0], path))
+    return lines[0], conflicts
+
+
+def _conflict(git, path, from_sha, to_sha, files):
+    """
+    A Conflict for merging `from_sha` into `to_sha` in the repository at
+    `path`, looking up their merge bases
+    """
+    status, bases, _ = git.merge_base('--all', to_sha, from_sha,
+                                      with_extended_output=True,
+                                      with_exceptions=False)
+    if status != 0:
+        bases = ''
+    return Conflict(path, files, from_sha, to_sha, bases.split())
+
+
+def _supermodule_conflicts(conflicts, merged_links):
+    """
+    The paths of the supermodule merge-tree `conflicts` that aren't
+    resolved by the submodule merges
+    """
+    # Conflicts in gitlinks are fine, since those are overwritten with
+    # the submodule merges; anything else is a real conflict
+    return set(path for mode, path in conflicts
+               if mode != '160000' or path not in merged_links)
+
+
+def _working_tree_conflicts(repo, executor, from_ref, to_ref):
+    """
+    The Conflicts left in the supermodule's and submodules' working trees
+    by a failed working tree merge of `from_ref` into `to_ref`, to be read
+    before they are reset
+    """
+    submodules = executor.paths()
+
+    def unmerged(path, git):
+        files = [name for name in git.diff('--name-only',
+                                           '--diff-filter=U').split('\n')
+                 if name and name not in submodules]
+        if not files:
+            return None
+        queries = object_queries(git)
+        return _conflict(git, path, queries.rev_parse(from_ref),
+                         queries.rev_parse(to_ref), files)
+
+    conflicts = [unmerged('', repo.git)]
+    conflicts.extend(executor.run(unmerged, submodules,
+                                  'diff --diff-filter=U').values())
+    return [conflict for conflict in conflicts if conflict is not None]
+
+
+def tree_deep_merge(repo, from_branch, to_branch, remote='origin',
+                    executor=None, pushes=None):
+    """
+    Deep merge from_branch into to_branch without checking anything out.
+
+    Each submodule is merged with `git merge-tree` and `git commit-tree`,
+    then the supermodule is merged the same way and its gitlinks rewritten
+    to point at the merged submodule commits. Branch refs are only updated
+    and pushed once every merge has succeeded, so a failure leaves nothing
+    to clean up. If `pushes` is a PushQueue, the updates are queued on it
+    instead of pushed
+    """
+    executor = executor or SubmoduleExecutor(repo)
+    remote_from_branch = "%s/%s" % (remote, from_branch)
+
+    from_sha = remote_tip(repo.git, remote, from_branch, pushes)
+    to_sha = remote_tip(repo.git, remote, to_branch, pushes)
+
+    # If there have been no commits on from_branch that aren't on to_branch,
+    # then we don't need to merge at all
+    if is_ancestor(repo, from_sha, to_sha):
+        return
+
+    def merge_submodule(path, git):
+        sub_from = remote_tip(git, remote, from_branch, pushes, path)
+        sub_to = remote_tip(git, remote, to_branch, pushes, path)
+        if is_ancestor(git, sub_from, sub_to):
+            return sub_to, sub_to, None
+        if is_ancestor(git, sub_to, sub_from):
+            return sub_to, sub_from, None
+        tree, conflicts = merge_tree(git, sub_to, sub_from)
+        if conflicts:
+            return sub_to, None, _conflict(
+                git, path, sub_from, sub_to,
+                set(path for _, path in conflicts))
+        return sub_to, git.commit_tree(
+            tree, '-p', sub_to, '-p', sub_from, '-m',
+            "Merge remote-tracking branch '%s' into %s" %
+            (remote_from_branch, to_branch)), None
+
+    submodules = executor.run(merge_submodule,
+                              description='merge %s' % remote_from_branch)
+    merged_links = dict((path, merged)
+                        for path, (_, merged, _) in submodules.items())
+
+    conflicts = [conflict for _, _, conflict in submodules.values()
+                 if conflict is not None]
+    if conflicts:
+        # Report the supermodule's own conflicts along with the submodules'
+        _, super_conflicts = merge_tree(repo, to_sha, from_sha)
+        unresolved = _supermodule_conflicts(super_conflicts, merged_links)
+        if unresolved:
+            conflicts.append(_conflict(repo.git, '', from_sha, to_sha,
+                                       unresolved))
+        raise MergeConflict(conflicts)
+
+    from_links = gitlinks(repo, from_sha)
+    if is_ancestor(repo, to_sha, from_sha) and \
+            [path for path, merged in merged_links.items()
+             if from_links.get(path, merged) != merged] == []:
+        # Every submodule ended up where from_branch already points,
+        # so the supermodule can simply fast-forward
+        new_sha = from_sha
+    else:
+        new_sha = _merge_supermodule(repo, to_sha, from_sha, merged_links,
+                                     "deep merged %s to %s" %
+                                     (from_branch, to_branch))
+
+    updates = dict((path, merged) for path, (old, merged, _)
+                   in submodules.items() if old != merged)
+    updates[''] = new_sha
+    _publish(repo, executor, remote, to_branch, updates, pushes)
+
+
+def remote_tip(git, remote, branch, pushes=None, path=''):
+    """
+    The commit at `remote`/`branch`, or the commit queued to be pushed
+    there on `pushes` for the repository at `path`
+    """
+    if pushes is not None and pushes.tip(path, branch) is not None:
+        return pushes.tip(path, branch)
+    return object_queries(git).rev_parse('%s/%s' % (remote, branch))
+
+
+def _publish(repo, executor, remote, branch, updates, pushes=None):
+    """
+    Point `branch` at the commits in `updates`, a dict of submodule path
+    (or '' for the supermodule) to sha, and push them, submodules first.
+    When `pushes` is a PushQueue they are queued on it instead
+    """
+    for path, sha in updates.items():
+        git = repo.git
+        if path != '':
+            git = executor.git(path)
+        git.update_ref('refs/heads/%s' % branch, sha)
+
+    if pushes is not None:
+        for path, sha in updates.items():
+            pushes.add(path, branch, sha)
+        return
+
+    executor.foreach('push', remote, branch,
+                     paths=[path for path in updates if path != ''])
+    if '' in updates:
+        repo.git.push(remote, branch)
+
+
+def _merge_supermodule(repo, to_sha, from_sha, merged_links, message):
+    """
+    Merge the supermodule commits in memory, resolving every gitlink to the
+    already-merged submodule commit in `merged_links`
+    """
+    tree, conflicts = merge_tree(repo, to_sha, from_sha)
+    unresolved = _supermodule_conflicts(conflicts, merged_links)
+    if unresolved:
+        raise MergeConflict([_conflict(repo.git, '', from_sha, to_sha,
+                                       unresolved)])
+
+    # Rewrite the gitlinks in a throwaway index
+    index_dir = tempfile.mkdtemp(dir=repo.git_dir)
+    try:
+        index_git = Git(repo.working_tree_dir)
+        index_git.update_environment(
+            GIT_INDEX_FILE=os.path.join(index_dir, 'index'))
+        index_git.read_tree(tree)
+        cacheinfo = []
+        for path in sorted(set(merged_links) & set(gitlinks(repo, tree))):
+            cacheinfo.extend(['--cacheinfo',
+                              '160000,%s,%s' % (merged_links[path], path)])
+        if cacheinfo:
+            index_git.update_index(*cacheinfo)
+        tree = index_git.write_tree()
+    finally:
+        shutil.rmtree(index_dir, ignore_errors=True)
+
+    return repo.git.commit_tree(tree, '-p', to_sha, '-p', from_sha,
+                                '-m', message)
+
+
+NO_OP = 'no-op'
+FAST_FORWARD = 'fast-forward'
+MERGE = 'merge'
+
+
+class PlannedMerge(object):
+    """
+    How merging `from_branch` into `to_branch` will go: `action` for the
+    merge as a whole, and `submodules`, a dict of path to the action for
+    each submodule
+    """
+    def __init__(self, from_branch, to_branch, action, submodules):
+        self.from_branch = from_branch
+        self.to_branch = to_branch
+        self.action = action
+        self.submodules = submodules
+
+    def __str__(self):
+        description = '%s -> %s: %s' % (self.from_branch, self.to_branch,
+                                        self.action)
+        details = ['%s %s' % (path, action)
+                   for path, action in sorted(self.submodules.items())
+                   if action != NO_OP]
+        if self.action != NO_OP and details:
+            description += ' (%s)' % ', '.join(details)
+        return description
+
+
+class MergePlanner(object):
+    """
+    Classifies merges as no-op, fast-forward or true merge in the
+    supermodule and every submodule, using only ref lookups and
+    `git merge-base --is-ancestor`.
+
+    Planning a chain also simulates each step, so that later merges are
+    classified against the branches as earlier merges will leave them. A
+    branch that a true merge will update is represented by the set of
+    commits its new merge commit will have as parents
+    """
+    def __init__(self, repo, remote='origin', executor=None, pushes=None):
+        self.repo = repo
+        self.remote = remote
+        self.executor = executor or SubmoduleExecutor(repo)
+        self.pushes = pushes
+        self.refs = {'': RefSnapshot(repo)}
+        self.refs.update(self.executor.run(lambda path, git: RefSnapshot(git),
+                                           description='for-each-ref'))
+        self.heads = {}
+        self._ancestry = {}
+
+    def _git(self, path):
+        if path == '':
+            return self.repo.git
+        return self.executor.git(path)
+
+    def _heads(self, path, branch):
+        if (path, branch) not in self.heads:
+            tip = None
+            if self.pushes is not None:
+                tip = self.pushes.tip(path, branch)
+            if tip is None:
+                tip = self.refs[path].tip(self.remote, branch)
+            if tip is None:
+                return None
+            self.heads[(path, branch)] = (tip,)
+        return self.heads[(path, branch)]
+
+    def _is_ancestor(self, path, ancestor, descendant):
+        key = (path, ancestor, descendant)
+        if key not in self._ancestry:
+            self._ancestry[key] = (ancestor == descendant or
+                                   is_ancestor(self._git(path), ancestor,
+                                               descendant))
+        return self._ancestry[key]
+
+    def _classify(self, path, from_branch, to_branch):
+        from_heads = self._heads(path, from_branch)
+        to_heads = self._heads(path, to_branch)
+        if from_heads is None or to_heads is None:
+            # Let the merge itself report the missing branch
+            return MERGE
+        if from_heads == to_heads:
+            return NO_OP
+        if len(from_heads) == 1 and [head for head in to_heads
+                                     if self._is_ancestor(path, from_heads[0],
+                                                          head)]:
+            return NO_OP
+        if len(to_heads) == 1 and [head for head in from_heads
+                                   if self._is_ancestor(path, to_heads[0],
+                                                        head)]:
+            return FAST_FORWARD
+        return MERGE
+
+    def _apply(self, path, from_branch, to_branch, action):
+        if action == FAST_FORWARD:
+            self.heads[(path, to_branch)] = self._heads(path, from_branch)
+        elif action == MERGE:
+            from_heads = self._heads(path, from_branch) or ()
+            to_heads = self._heads(path, to_branch) or ()
+            self.heads[(path, to_branch)] = tuple(
+                sorted(set(from_heads + to_heads)))
+
+    def classify(self, from_branch, to_branch):
+        action = self._classify('', from_branch, to_branch)
+        submodules = {}
+        if action != NO_OP:
+            submodules = self.executor.run(
+                lambda path, git: self._classify(path, from_branch,
+                                                 to_branch),
+                paths=[path for path in self.refs if path != ''],
+                description='classify %s -> %s' % (from_branch, to_branch))
+        # The supermodule can only fast-forward if every submodule ends up
+        # where from_branch points
+        if action == FAST_FORWARD and \
+                [path for path, submodule_action in submodules.items()
+                 if submodule_action != FAST_FORWARD and
+                 self._heads(path, from_branch) !=
+                 self._heads(path, to_branch)]:
+            action = MERGE
+        return PlannedMerge(from_branch, to_branch, action, submodules)
+
+    def plan(self, pairs):
+        """
+        Classify each (from_branch, to_branch) pair, in order, as if the
+        earlier ones had already been carried out
+        """
+        planned = []
+        for from_branch, to_branch in pairs:
+            step = self.classify(from_branch, to_branch)
+            planned.append(step)
+            if step.action == NO_OP:
+                continue
+            self._apply('', from_branch, to_branch, step.action)
+            for path, action in step.submodules.items():
+                if step.action == FAST_FORWARD:
+                    action = FAST_FORWARD
+                self._apply(path, from_branch, to_branch, action)
+        return planned
+
+
+def plan_merges(repo, branches, remote='origin', executor=None,
+                pushes=None):
+    """
+    Plan merging each branch in `branches` into the next one
+    """
+    return MergePlanner(repo, remote, executor, pushes).plan(
+        zip(branches, branches[1:]))
+
+
+def fast_forward_refs(repo, from_branch, to_branch, remote='origin',
+                      executor=None, pushes=None):
+    """
+    Fast-forward to_branch to from_branch in the supermodule and every
+    submodule by updating refs directly, then push (or queue the pushes on
+    `pushes`). Nothing is checked out. Raises GitCommandError, before
+    changing anything, if any repository can't be fast-forwarded
+    """
+    executor = executor or SubmoduleExecutor(repo)
+    remote_from_branch = "%s/%s" % (remote, from_branch)
+    remote_to_branch = "%s/%s" % (remote, to_branch)
+
+    def check(git, path=''):
+        from_sha = remote_tip(git, remote, from_branch, pushes, path)
+        to_sha = remote_tip(git, remote, to_branch, pushes, path)
+        if not is_ancestor(git, to_sha, from_sha):
+            raise GitCommandError(
+                ['git', 'merge', '--ff-only', remote_from_branch], 1,
+                'Not possible to fast-forward %s to %s' %
+                (remote_to_branch, remote_from_branch))
+        return to_sha, from_sha
+
+    new_sha = check(repo.git)[1]
+    submodules = executor.run(lambda path, git: check(git, path),
+                              description='check fast-forward')
+
+    updates = dict((path, new) for path, (old, new) in submodules.items()
+                   if old != new)
+    updates[''] = new_sha
+    _publish(repo, executor, remote, to_branch, updates, pushes)
+
+
+def deep_merge(repo, from_branch, to_branch, remote='origin', executor=None,
+               in_memory=None, pushes=None):
     """
     Do a fast-forward deep merge from `from_branch` to `to_branch` if
     possible, otherwise do a regular deep merge.
+
+    The merge is planned first, so no-ops are skipped and fast-forwards
+    done as ref updates without checking anything out. When `in_memory` is
+    true, or left as None and git is new enough, true merges are done by
+    tree_deep_merge without touching the working tree either.
+
+    If `pushes` is a PushQueue, updates are queued on it rather than pushed
+    straight away (except by the working tree merge, which pushes anything
+    already queued and then its own changes)
     """
-    # If there are no commits in from_branch that are not in to_branch
-    # then we can do a fast forward merge
-    if repo.git.log('%s/%s..%s/%s' % (remote, from_branch,
-                                      remote, to_branch)) == []:
-        fast_forward_deep_merge(repo, from_branch, to_branch)
-    else:
-        no_ff_deep_merge(repo, from_branch, to_branch)
+    executor = executor or SubmoduleExecutor(repo)
+    action = MergePlanner(repo, remote, executor, pushes).classify(
+        from_branch, to_branch).action
+    _run_planned(repo, from_branch, to_branch, action, remote, executor,
+                 in_memory, pushes)
+
+
+def _run_planned(repo, from_branch, to_branch, action, remote, executor,
+                 in_memory=None, pushes=None, push=True):
+    merge_span = release_trace.span('merge', from_branch=from_branch,
+                                    to_branch=to_branch, action=action)
+    try:
+        _run_action(repo, from_branch, to_branch, action, remote, executor,
+                    in_memory, pushes, push)
+    finally:
+        merge_span.end()
+
+
+def _run_action(repo, from_branch, to_branch, action, remote, executor,
+                in_memory=None, pushes=None, push=True):
+    if action == NO_OP:
+        logging.info('Nothing to merge from %s into %s' %
+                     (from_branch, to_branch))
+        return
+    if action == FAST_FORWARD:
+        try:
+            return fast_forward_refs(repo, from_branch, to_branch, remote,
+                                     executor, pushes)
+        except GitCommandError:
+            # The branches moved since the merge was planned
+            logging.info('Unable to fast-forward %s to %s, merging instead'
+                         % (to_branch, from_branch))
+
+    if in_memory is None:
+        in_memory = supports_tree_merge(repo)
+    if in_memory:
+        tree_deep_merge(repo, from_branch, to_branch, remote, executor,
+                        pushes)
+        return
+
+    # The working tree merge pushes its result, and anything queued before
+    # it, so it can't be used when nothing is to be pushed
+    if not push:
+        raise GitCommandError(['git', 'merge', '--no-commit'], 1,
+                              'Merges without pushing need git %s or newer, '
+                              'to merge in memory' %
+                              '.'.join(map(str, TREE_MERGE_GIT_VERSION)))
+
+    # The working tree merge starts from the remote branches, so anything
+    # queued has to be pushed first
+    if pushes is not None and pushes.pending:
+        _, rejected = pushes.flush()
+        if rejected:
+            raise GitCommandError(['git', 'push', '--atomic'], 1,
+                                  'Queued pushes were rejected')
+    no_ff_deep_merge(repo, from_branch, to_branch, remote, executor)
+
+
+class WorktreePool(object):
+    """
+    Linked worktrees of `repo`, one per concurrent worker, so working tree
+    merges can run side by side. Each worktree's submodules are cloned with
+    `--reference` to the main checkout's submodules, sharing their objects.
+
+    The submodule clones have refs of their own, so a reused worktree's
+    submodules are fetched from `remote` again before it is handed out, to
+    pick up what other workers have pushed since
+    """
+    def __init__(self, repo, remote='origin'):
+        self.repo = repo
+        self.remote = remote
+        self.idle = Queue.Queue()
+        self.paths = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        try:
+            worktree = self.idle.get_nowait()
+        except Queue.Empty:
+            return self._create()
+        SubmoduleExecutor(worktree).foreach('fetch', self.remote)
+        return worktree
+
+    def release(self, worktree):
+        # Leave no branch checked out, so the next merge into it can run
+        # anywhere
+        try:
+            worktree.git.checkout('-f', '--detach')
+        except GitCommandError:
+            logging.warning('Unable to detach worktree %s, not reusing it' %
+                            worktree.working_tree_dir)
+            return
+        self.idle.put(worktree)
+
+    def _create(self):
+        self.lock.acquire()
+        try:
+            base = os.path.join(self.repo.git_dir, 'release-path', 'worktrees')
+            if not os.path.isdir(base):
+                os.makedirs(base)
+            path = tempfile.mkdtemp(prefix='worker-', dir=base)
+            self.repo.git.worktree('add', '--detach', path, 'HEAD')
+            self.paths.append(path)
+        finally:
+            self.lock.release()
+
+        worktree = Repo(path)
+        for submodule in SubmoduleExecutor(self.repo).paths():
+            worktree.git.submodule(
+                'update', '--init', '--reference',
+                os.path.join(self.repo.working_tree_dir, submodule),
+                '--', submodule)
+        return worktree
+
+    def close(self):
+        for path in self.paths:
+            try:
+                self.repo.git.worktree('remove', '--force', path)
+            except GitCommandError:
+                logging.warning('Unable to remove worktree %s' % path)
+                shutil.rmtree(path, ignore_errors=True)
+        self.repo.git.worktree('prune')
+        self.paths = []
+
+
+def _lasting_failure(error):
+    """
+    Whether a merge that failed with `error` will fail the same way until
+    its branches move. Anything else, such as a rejected push or a network
+    error, is worth retrying and isn't recorded in MergeHistory
+    """
+    return isinstance(error, (MergeConflict, InvalidSubmoduleBranch))
+
+
+def parallel_deep_merge(repo, pairs, remote='origin', jobs=DEFAULT_WORKERS,
+                        in_memory=None, history=None):
+    """
+    Deep merge each (from_branch, to_branch) of `pairs`, running up to
+    `jobs` merges at once. Returns a dict mapping each failed pair to its
+    error.
+
+    If `history` is a MergeHistory, pairs whose branches haven't moved since
+    the last run are skipped, and reported as failed if they failed then
+    """
+    scheduler = MergeScheduler(repo, remote, jobs, in_memory)
+    failures = {}
+    for from_branch, to_branch in pairs:
+        result = None
+        if history is not None:
+            result = history.last_result(from_branch, to_branch)
+        if result is None:
+            scheduler.add(from_branch, to_branch)
+        elif result['succeeded']:
+            logging.info('Skipping merge from %s into %s: already merged at '
+                         'these tips' % (from_branch, to_branch))
+        else:
+            logging.error('Skipping merge from %s into %s: it failed at these '
+                          'tips last time' % (from_branch, to_branch))
+            failures[(from_branch, to_branch)] = Exception(
+                'Failed at these tips last time: %s' % result['error'])
+
+    failures.update(scheduler.run())
+    if history is not None:
+        history.refresh()
+        for from_branch, to_branch in scheduler.merges:
+            state = scheduler.state.get((from_branch, to_branch))
+            if state == MergeScheduler.SUCCEEDED:
+                history.record(from_branch, to_branch, True)
+            elif state == MergeScheduler.FAILED and \
+                    _lasting_failure(failures[(from_branch, to_branch)]):
+                history.record(from_branch, to_branch, False,
+                               str(failures[(from_branch, to_branch)]))
+        history.save()
+    return failures
+
+
+class MergeScheduler(object):
+    """
+    Runs a graph of deep merges, up to `jobs` at a time.
+
+    A merge out of a branch waits for every merge into that branch, and for
+    any merges named when it was added; merges into the same branch never
+    run at once. A merge starts as soon as everything it waits for has
+    succeeded, and is skipped if any of those failed or were skipped.
+
+    In-memory merges never touch a working tree, so they share `repo`;
+    working tree merges each get a worktree of their own
+    """
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    SKIPPED = 'skipped'
+
+    def __init__(self, repo, remote='origin', jobs=DEFAULT_WORKERS,
+                 in_memory=None):
+        self.repo = repo
+        self.remote = remote
+        self.jobs = jobs
+        self.in_memory = in_memory
+        self.merges = []
+        self.after = {}
+        self.state = {}
+        self.failures = {}
+        self.skipped = {}
+
+    def add(self, from_branch, to_branch, after=()):
+        """
+        Add a merge from `from_branch` to `to_branch` that also waits for
+        the (from_branch, to_branch) merges in `after`
+        """
+        merge = (from_branch, to_branch)
+        if merge not in self.after:
+            self.merges.append(merge)
+            self.after[merge] = set()
+        self.after[merge].update(after)
+        return merge
+
+    def fail(self, from_branch, to_branch, error):
+        """
+        Record the merge from `from_branch` to `to_branch` as failed without
+        running it, so everything waiting for it is skipped
+        """
+        merge = self.add(from_branch, to_branch)
+        self.state[merge] = self.FAILED
+        self.failures[merge] = error
+
+    def dependencies(self, merge):
+        """
+        The merges `merge` waits for, among those added
+        """
+        after = set(other for other in self.after[merge]
+                    if other in self.after)
+        return after.union(other for other in self.merges
+                           if other[1] == merge[0])
+
+    def downstream(self, branches):
+        """
+        A new scheduler with only the merges that carry changes from any of
+        `branches`: the merges out of them, out of the branches those merge
+        into, and so on
+        """
+        changed = set(branches)
+        selected = set()
+        grew = True
+        while grew:
+            grew = False
+            for merge in self.merges:
+                if merge not in selected and merge[0] in changed:
+                    selected.add(merge)
+                    changed.add(merge[1])
+                    grew = True
+
+        scheduler = MergeScheduler(self.repo, self.remote, self.jobs,
+                                   self.in_memory)
+        for merge in self.merges:
+            if merge not in selected:
+                continue
+            scheduler.add(merge[0], merge[1], self.after[merge])
+            if merge in self.failures:
+                scheduler.fail(merge[0], merge[1], self.failures[merge])
+        return scheduler
+
+    def _next(self, busy):
+        """
+        The first merge ready to run, skipping any that can no longer run.
+        Call with the lock held
+        """
+        changed = True
+        while changed:
+            changed = False
+            for merge in self.merges:
+                if merge in self.state:
+                    continue
+                states = [(self.state.get(dependency), dependency)
+                          for dependency in self.dependencies(merge)]
+                broken = [dependency for state, dependency in states
+                          if state in (self.FAILED, self.SKIPPED)]
+                if broken:
+                    logging.warning('Skipping merge from %s into %s, since '
+                                    'the merge from %s into %s did not '
+                                    'succeed' % (merge + broken[0]))
+                    self.state[merge] = self.SKIPPED
+                    self.skipped[merge] = broken[0]
+                    changed = True
+                    continue
+                if merge[1] in busy:
+                    continue
+                if all(state == self.SUCCEEDED for state, _ in states):
+                    return merge
+
+        if not busy:
+            # Nothing is running, so anything left waits on a cycle
+            for merge in self.merges:
+                if merge not in self.state:
+                    logging.error('Skipping merge from %s into %s, since it '
+                                  'depends on itself' % merge)
+                    self.state[merge] = self.SKIPPED
+                    self.skipped[merge] = merge
+        return None
+
+    def run(self):
+        """
+        Run every merge, returning a dict of the failed (from_branch,
+        to_branch) merges to their errors. Skipped merges are left in
+        `skipped`, mapped to the failed or skipped merge they waited for
+        """
+        in_memory = self.in_memory
+        if in_memory is None:
+            in_memory = supports_tree_merge(self.repo)
+        worktrees = None
+        if not in_memory:
+            worktrees = WorktreePool(self.repo, self.remote)
+        lock = threading.Condition()
+        busy = set()
+        parent = release_trace.current()
+
+        def merge_one(from_branch, to_branch):
+            job_span = release_trace.span('scheduled merge', parent,
+                                          from_branch=from_branch,
+                                          to_branch=to_branch)
+            target_repo = self.repo
+            if worktrees is not None:
+                target_repo = worktrees.acquire()
+            try:
+                logging.info('Merging %s into %s' % (from_branch, to_branch))
+                deep_merge(target_repo, from_branch, to_branch, self.remote,
+                           SubmoduleExecutor(target_repo), in_memory)
+            finally:
+                if worktrees is not None:
+                    worktrees.release(target_repo)
+                job_span.end()
+
+        def worker():
+            lock.acquire()
+            try:
+                while True:
+                    merge = self._next(busy)
+                    if merge is None:
+                        if len(self.state) == len(self.merges):
+                            lock.notifyAll()
+                            return
+                        lock.wait()
+                        continue
+
+                    self.state[merge] = self.RUNNING
+                    busy.add(merge[1])
+                    lock.release()
+                    try:
+                        try:
+                            merge_one(*merge)
+                            state = self.SUCCEEDED
+                        except Exception:
+                            logging.error('Failed to merge %s into %s: %s' %
+                                          (merge + (sys.exc_info()[1],)))
+                            self.failures[merge] = sys.exc_info()[1]
+                            state = self.FAILED
+                    finally:
+                        lock.acquire()
+                    self.state[merge] = state
+                    busy.discard(merge[1])
+                    lock.notifyAll()
+            finally:
+                lock.release()
+
+        try:
+            threads = [threading.Thread(target=worker)
+                       for _ in range(max(1, min(self.jobs,
+                                                 len(self.merges))))]
+            for thread in threads:
+                thread.setDaemon(True)
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            if worktrees is not None:
+                worktrees.close()
+        return self.failures
 
 
 def submodule_status(repo):
@@ -229,30 +2151,123 @@ def submodule_status(repo):
         if status == '':
             continue
         up_to_date = status[0]
-        commit_hash = status[1:40]
+        commit_hash = status[1:41]
         path, _, branch_id = status[42:].partition(' ')
         submodules[path] = (up_to_date, commit_hash, branch_id)
     return submodules
 
 
 def verify_submodule_branch_structure(repo, branch_name, fetch=True,
-                                      remote='origin'):
+                                      remote='origin', executor=None):
     """
     Throws an exception unless the commit at the tip of branch_name
     in the supermodule points to the tip of branch_name in each of
     the submodules
     """
-    remote_branch = '/'.join([remote, branch_name])
+    if not verify_branches(repo, [branch_name], fetch, remote,
+                           executor)[branch_name]:
+        raise InvalidSubmoduleBranch(branch_name)
 
-    repo.git.reset('--hard', 'HEAD')
-    repo.git.checkout('-f', branch_name)
-    repo.git.reset('--hard', remote_branch)
+
+def init_submodules(repo, fetch=True, lean=False, executor=None):
+    """
+    Initialize any submodules that have never been initialized, as blobless
+    partial clones if `lean`. Nothing is run if `executor` already knows
+    every submodule is initialized
+    """
+    if executor is not None and executor.initialized():
+        return
+    if [path for path, (state, _, _) in submodule_status(repo).items()
+            if state == '-']:
+        if not fetch:
+            repo.git.submodule('update', '--init', '--no-fetch')
+        elif lean:
+            repo.git.submodule('update', '--init', '--filter=%s' % LEAN_FILTER)
+        else:
+            repo.git.submodule('update', '--init')
+
+
+def verify_branches(repo, branches, fetch=True, remote='origin',
+                    executor=None, cache=True, fetcher=None):
+    """
+    Check the submodule branch structure of every branch in `branches`
+    at once, returning a dict of branch name to whether it is valid.
+
+    A branch is valid when the commit each submodule's gitlink points to at
+    the tip of the supermodule's `remote`/branch has the same content as
+    that submodule's own `remote`/branch. Only objects are read: nothing is
+    checked out, apart from initializing submodules that have never been
+    initialized. Results are cached on disk, keyed by the supermodule and
+    submodule tips, so unchanged branches aren't checked again.
+
+    When `fetch` is set, submodules are fetched first, through `fetcher`
+    if one is given (which is a no-op if it has already fetched)
+    """
+    executor = executor or SubmoduleExecutor(repo)
+
+    init_submodules(repo, fetch, executor=executor)
     if fetch:
-        repo.git.submodule('update', '--init')
-        repo.git.submodule('foreach', 'git fetch')
-    else:
-        repo.git.submodule('update', '--init', '--no-fetch')
-    try:
-        repo.git.submodule('foreach', "git diff --quiet %s" % remote_branch)
-    except GitCommandError:
-        raise InvalidSubmoduleBranch(branch_name)
+        if fetcher is not None:
+            fetcher.fetch()
+        else:
+            executor.foreach('fetch')
+
+    refs = RefSnapshot(repo)
+    submodule_refs = executor.run(lambda path, git: RefSnapshot(git),
+                                  description='for-each-ref')
+    state = None
+    if cache:
+        state = StateFile(repo, 'verified-branches.json')
+
+    results = {}
+    for branch in branches:
+        tip = refs.tip(remote, branch)
+        if tip is None:
+            logging.error('No such branch %s/%s' % (remote, branch))
+            results[branch] = False
+            continue
+
+        key = hashlib.sha1(' '.join(
+            [tip] + ['%s:%s' % (path, submodule_refs[path].tip(remote, branch))
+                     for path in sorted(submodule_refs)])).hexdigest()
+        if state is not None and key in state:
+            results[branch] = state.get(key)
+            continue
+
+        results[branch] = _gitlinks_match(repo, executor, submodule_refs,
+                                          remote, branch, tip)
+        if state is not None:
+            state.set(key, results[branch])
+
+    if state is not None:
+        state.save()
+    return results
+
+
+def _gitlinks_match(repo, executor, submodule_refs, remote, branch, tip):
+    for path, link in sorted(gitlinks(repo, tip).items()):
+        if path not in submodule_refs:
+            logging.error('Submodule %s of %s/%s is not initialized' %
+                          (path, remote, branch))
+            return False
+        submodule_tip = submodule_refs[path].tip(remote, branch)
+        if submodule_tip is None:
+            logging.error('Submodule %s has no branch %s/%s' %
+                          (path, remote, branch))
+            return False
+        if link == submodule_tip:
+            continue
+        # A different commit with the same content is still acceptable
+        queries = object_queries(executor.git(path))
+        trees = [queries.resolve(link, 'tree'),
+                 queries.resolve(submodule_tip, 'tree')]
+        if None in trees:
+            logging.error('Submodule %s is missing commit %s from %s/%s' %
+                          (path, link, remote, branch))
+            return False
+        if trees[0] != trees[1]:
+            logging.error('Submodule %s of %s/%s points at %s, not at the '
+                          'tip of its own %s/%s' %
+                          (path, remote, branch, link, remote, branch))
+            return False
+    return True
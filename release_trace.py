@@ -0,0 +1,300 @@
+# This file is part of release-path
+#
+#Copyright (c) 2012 Wireless Generation, Inc.
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#THE SOFTWARE.
+
+"""
+Timing instrumentation for the git commands run through GitPython.
+
+Once enabled, every call to git.cmd.Git.execute is recorded with its
+arguments, elapsed time, exit status and output size, attributed to the
+innermost open span of the calling thread. Spans mark larger steps, such
+as merging one branch pair or working on one submodule.
+"""
+
+import sys
+import time
+import atexit
+import logging
+import threading
+
+import git.cmd
+from git import GitCommandError
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+class Span(object):
+    """
+    A named, timed step; `end` must be called once the step is over
+    """
+    def __init__(self, tracer, name, attributes, parent):
+        self.tracer = tracer
+        self.id = tracer._next_id()
+        self.name = name
+        self.attributes = attributes
+        self.parent = parent
+        self.start = time.time()
+        self.elapsed = None
+
+    def end(self):
+        if self.elapsed is not None:
+            return
+        self.elapsed = time.time() - self.start
+        self.tracer._close(self)
+
+
+class Tracer(object):
+    """
+    Collects the commands and spans of one run
+    """
+    def __init__(self):
+        self.enabled = False
+        self.started = time.time()
+        self.commands = []
+        self.spans = []
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._ids = 0
+        self._local = threading.local()
+        self._execute = None
+
+    def enable(self):
+        if self.enabled:
+            return
+        self.enabled = True
+        self._execute = git.cmd.Git.execute
+        execute = self._execute
+        tracer = self
+
+        def traced_execute(git_self, command, *args, **kwargs):
+            return tracer._record(execute, git_self, command, args, kwargs)
+        git.cmd.Git.execute = traced_execute
+
+    def disable(self):
+        if not self.enabled:
+            return
+        git.cmd.Git.execute = self._execute
+        self.enabled = False
+
+    def _next_id(self):
+        self._lock.acquire()
+        try:
+            self._ids += 1
+            return self._ids
+        finally:
+            self._lock.release()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def current(self):
+        """
+        The innermost open span of the calling thread, or None
+        """
+        stack = self._stack()
+        if stack:
+            return stack[-1]
+        return None
+
+    def span(self, name, parent=None, **attributes):
+        """
+        Open a span in the calling thread. `parent` defaults to the
+        thread's current span; pass one explicitly when handing work to
+        another thread
+        """
+        if parent is None:
+            parent = self.current()
+        span = Span(self, name, attributes, parent)
+        self._stack().append(span)
+        return span
+
+    def _close(self, span):
+        stack = self._stack()
+        if span in stack:
+            stack.remove(span)
+        if not self.enabled:
+            return
+        self._lock.acquire()
+        try:
+            self.spans.append(span)
+        finally:
+            self._lock.release()
+
+    def count(self, name, amount=1):
+        """
+        Add `amount` to the counter `name`, for work that isn't a git
+        command of its own
+        """
+        if not self.enabled:
+            return
+        self._lock.acquire()
+        try:
+            self.counters[name] = self.counters.get(name, 0) + amount
+        finally:
+            self._lock.release()
+
+    def _record(self, execute, git_self, command, args, kwargs):
+        start = time.time()
+        status = 0
+        output_bytes = None
+        result = None
+        try:
+            result = execute(git_self, command, *args, **kwargs)
+        except GitCommandError:
+            status = sys.exc_info()[1].status
+            raise
+        finally:
+            elapsed = time.time() - start
+            if status == 0:
+                if isinstance(result, tuple):
+                    status = result[0]
+                    output_bytes = len(result[1] or '') + len(result[2] or '')
+                elif isinstance(result, basestring):
+                    output_bytes = len(result)
+
+            span = self.current()
+            entry = {
+                'args': [str(arg) for arg in command],
+                'cwd': git_self._working_dir,
+                'start': start - self.started,
+                'elapsed': elapsed,
+                'status': status,
+                'output_bytes': output_bytes,
+                'thread': threading.currentThread().getName(),
+                'span': span and span.id,
+            }
+            self._lock.acquire()
+            try:
+                self.commands.append(entry)
+            finally:
+                self._lock.release()
+        return result
+
+    def to_dict(self):
+        spans = []
+        for span in self.spans:
+            spans.append({
+                'id': span.id,
+                'name': span.name,
+                'attributes': span.attributes,
+                'parent': span.parent and span.parent.id,
+                'start': span.start - self.started,
+                'elapsed': span.elapsed,
+            })
+        return {
+            'elapsed': time.time() - self.started,
+            'commands': self.commands,
+            'spans': spans,
+            'counters': self.counters,
+        }
+
+    def write(self, filename):
+        out = open(filename, 'w')
+        try:
+            json.dump(self.to_dict(), out, indent=1, default=str)
+        finally:
+            out.close()
+
+    def summary(self):
+        """
+        A table of the number of calls and time spent per git command,
+        slowest first, followed by the counters
+        """
+        totals = {}
+        for entry in self.commands:
+            name = command_type(entry['args'])
+            count, total, slowest, output = totals.get(name, (0, 0.0, 0.0, 0))
+            totals[name] = (count + 1, total + entry['elapsed'],
+                            max(slowest, entry['elapsed']),
+                            output + (entry['output_bytes'] or 0))
+
+        lines = ['%-20s %8s %10s %10s %12s' %
+                 ('command', 'calls', 'total (s)', 'max (s)', 'output')]
+        for name, (count, total, slowest, output) in sorted(
+                totals.items(), key=lambda item: -item[1][1]):
+            lines.append('%-20s %8d %10.3f %10.3f %12d' %
+                         (name, count, total, slowest, output))
+        for name, value in sorted(self.counters.items()):
+            lines.append('%-29s %d' % (name + ':', value))
+        return '\n'.join(lines)
+
+
+def command_type(args):
+    """
+    The git subcommand of a command line such as ['git', '-c', 'x=y',
+    'rev-parse', 'HEAD']
+    """
+    args = list(args[1:])
+    while args:
+        arg = args.pop(0)
+        if arg in ('-c', '-C'):
+            if args:
+                args.pop(0)
+        elif not arg.startswith('-'):
+            return arg
+    return 'git'
+
+
+TRACER = Tracer()
+
+
+def span(name, parent=None, **attributes):
+    """
+    Open a span on the global tracer
+    """
+    return TRACER.span(name, parent, **attributes)
+
+
+def current():
+    return TRACER.current()
+
+
+def count(name, amount=1):
+    TRACER.count(name, amount)
+
+
+def add_trace_argument(parser):
+    parser.add_argument('--trace', metavar='FILE', default=None,
+                        help="Write a JSON trace of every git command to FILE "
+                        "and print a summary of time spent per command")
+
+
+def start(filename):
+    """
+    Trace the rest of the run if `filename` is set, writing the trace there
+    and printing the summary to stderr on exit
+    """
+    if not filename:
+        return
+    TRACER.enable()
+    start_span = span('run', argv=sys.argv)
+
+    def finish():
+        start_span.end()
+        TRACER.write(filename)
+        sys.stderr.write(TRACER.summary() + '\n')
+        logging.info('Wrote git trace to %s' % filename)
+    atexit.register(finish)
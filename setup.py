@@ -12,11 +12,14 @@ setup(
              'mk_release_branch',
              'merge_branch_upstream',
              'merge_products_upstream',
+             'merge_all_upstream',
+             'merge_daemon',
+             'merge_fleet',
              'merge_upstream_star',
              'single_merge',
              'verify_guards'
             ],
-    py_modules=['release_path', 'release_branch_manager'],
+    py_modules=['release_path', 'release_branch_manager', 'release_trace'],
     setup_requires=['nose'],
     install_requires=[
         'simpleversions==0.1.2',